@@ -0,0 +1,138 @@
+"""Bulk writes behind the batch endpoints.
+
+Each function writes a whole batch with multi-row INSERT ... ON CONFLICT DO
+NOTHING statements in the caller's transaction and reports one status per
+requested item, in request order:
+
+- "created": the row was written by this call;
+- "exists": the row was already there (or repeated in the batch);
+- "not_found": the referenced tweet or user does not exist.
+
+Rows are inserted from a SELECT over the referenced table, so unknown ids
+are skipped instead of aborting the transaction with a foreign key error.
+The caller commits once and then runs invalidate_follows for cached state.
+"""
+
+from typing import Dict, Iterable, List, cast
+
+from sqlalchemy import Table, bindparam, literal, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.etags import bump
+from app.follow_graph import invalidate_following
+from app.models import Media, Tweet, User, likes_table, user_following
+from app.profiles import invalidate_profiles
+from app.schemas import TweetIn
+from app.timeline import fan_out_tweet, follow_author
+
+
+def _statuses(
+    requested: List[int], found: Iterable[int], created: Iterable[int]
+) -> List[Dict]:
+    found, created = set(found), set(created)
+    items = []
+    for id in requested:
+        if id in created:
+            status = "created"
+            created.discard(id)
+        elif id in found:
+            status = "exists"
+        else:
+            status = "not_found"
+        items.append({"id": id, "status": status})
+    return items
+
+
+async def add_likes(
+    db: AsyncSession, user_id: int, tweet_ids: List[int]
+) -> List[Dict]:
+    """Like every tweet of tweet_ids on behalf of user_id"""
+    wanted = sorted(set(tweet_ids))
+    live = (Tweet.id.in_(wanted), Tweet.deleted_at.is_(None))
+    found = await db.scalars(select(Tweet.id).where(*live))
+    rows = select(literal(user_id), Tweet.id).where(*live)
+    created = list(
+        await db.scalars(
+            insert(likes_table)
+            .from_select(["user_id", "tweet_id"], rows)
+            .on_conflict_do_nothing()
+            .returning(likes_table.c.tweet_id)
+        )
+    )
+    if created:
+        await db.execute(
+            update(Tweet)
+            .where(Tweet.id.in_(created))
+            .values(like_count=Tweet.like_count + 1)
+        )
+    return _statuses(tweet_ids, found, created)
+
+
+async def add_follows(
+    db: AsyncSession, follower_id: int, user_ids: List[int], fan_out=False
+) -> List[Dict]:
+    """Make follower_id follow every user of user_ids, copying their tweets
+    into the follower's timeline if fan_out"""
+    wanted = sorted(set(user_ids))
+    found = await db.scalars(select(User.id).where(User.id.in_(wanted)))
+    rows = select(User.id, literal(follower_id)).where(User.id.in_(wanted))
+    created = list(
+        await db.scalars(
+            insert(user_following)
+            .from_select(["user_id", "follower_id"], rows)
+            .on_conflict_do_nothing()
+            .returning(user_following.c.user_id)
+        )
+    )
+    if fan_out:
+        for user_id in created:
+            await follow_author(db, follower_id, user_id)
+    return _statuses(user_ids, found, created)
+
+
+async def invalidate_follows(follower_id: int, items: List[Dict]) -> None:
+    """Must be called after the edges written by add_follows are
+    committed"""
+    changed = [item["id"] for item in items if item["status"] == "created"]
+    if changed:
+        invalidate_following(follower_id)
+        await bump(f"following:{follower_id}")
+        await invalidate_profiles(follower_id, *changed)
+
+
+async def add_tweets(
+    db: AsyncSession, author_id: int, tweets: List[TweetIn], fan_out=False
+) -> List[int]:
+    """Write tweets of author_id, attach their media if uploaded by
+    author_id and not attached yet, push them into timelines if fan_out and
+    return the new ids in the order of tweets"""
+    if not tweets:
+        return []
+    result = await db.execute(
+        insert(Tweet).returning(Tweet.id, sort_by_parameter_order=True),
+        [{"content": t.tweet_data, "author_id": author_id} for t in tweets],
+    )
+    tweet_ids = list(result.scalars())
+    attachments = [
+        {"media_id": media_id, "new_tweet_id": tweet_id}
+        for tweet, tweet_id in zip(tweets, tweet_ids)
+        for media_id in tweet.tweet_media_ids
+    ]
+    if attachments:
+        media = cast(Table, Media.__table__)
+        # only uploads of the author that no tweet uses yet
+        await db.execute(
+            update(media)
+            .where(
+                media.c.id == bindparam("media_id"),
+                media.c.user_id == author_id,
+                media.c.tweet_id.is_(None),
+            )
+            .values(tweet_id=bindparam("new_tweet_id")),
+            attachments,
+        )
+    if fan_out:
+        for tweet_id in tweet_ids:
+            await fan_out_tweet(db, tweet_id, author_id)
+    return tweet_ids
@@ -0,0 +1,534 @@
+"""Bulk import and export of users, follows, tweets, likes and media.
+
+    python -m app.bulk export tweets -o tweets.ndjson
+    python -m app.bulk import tweets tweets.ndjson
+    python -m app.bulk generate --users 1000000 --reset
+
+Data is moved with COPY, as NDJSON (one JSON object per line) or CSV with
+a header line; the format follows the file extension unless --format is
+given. Rows are streamed, so memory use does not grow with the table.
+
+Export runs a single COPY ... TO STDOUT. NDJSON is produced by Postgres
+with row_to_json and written out as is.
+
+Import reads BULK_BATCH_SIZE rows at a time, copies them into a temporary
+table and moves them into the target with INSERT ... ON CONFLICT DO
+NOTHING, one transaction per batch. Columns missing from the input get
+their defaults. After each batch the byte offset reached in the input is
+saved to a checkpoint file (<input>.checkpoint), and an interrupted import
+run again resumes from there; rows written twice are skipped by the
+conflict clause. Sequences are moved past imported ids, and like counts
+are recounted after likes are imported.
+
+generate fills an empty database with a synthetic dataset for the
+benchmarks (api keys "bench-<id>", as benchmarks.seed): follows and tweet
+authors drawn from a power law, heavy-tailed like counts, media on a share
+of tweets. Rows are produced on the fly and copied straight into the
+tables, which takes a few minutes for millions of rows.
+
+Progress and rows/s are reported on stderr about every second.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+import asyncpg  # type: ignore[import-untyped]
+import orjson
+from sqlalchemy import Column, Table
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+from app.database import PG_PGBOUNCER, database_url, engine_options
+from app.likes import reconcile_like_counts
+from app.models import Base
+from app.timeline import rebuild_timelines
+
+TABLES = ("users", "user_following", "tweets", "likes", "medias")
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 50000))
+REPORT_INTERVAL = 1.0
+# tables emptied by generate --reset
+GENERATED_TABLES = (
+    "media_variants",
+    "medias",
+    "timelines",
+    "likes",
+    "user_following",
+    "tweets",
+    "keys",
+    "users",
+)
+# seconds back over which generated likes are spread
+LIKE_SPREAD = 7 * 24 * 3600
+WORDS = ("walrus", "python", "postgres", "coffee", "river", "music")
+
+Offset = int
+Record = Tuple[Any, ...]
+
+
+class Progress:
+    """Rows done and their rate, reported to stderr about every second"""
+
+    def __init__(self, label: str, rows: int = 0):
+        self.label = label
+        self.rows = rows
+        self.start_rows = rows
+        self.start = self.reported = time.perf_counter()
+
+    def add(self, rows: int) -> None:
+        self.rows += rows
+        now = time.perf_counter()
+        if now - self.reported >= REPORT_INTERVAL:
+            self.reported = now
+            self.report()
+
+    def rate(self) -> float:
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return (self.rows - self.start_rows) / elapsed
+
+    def report(self, done: bool = False) -> None:
+        state = "done" if done else "..."
+        print(
+            f"{self.label}: {self.rows} rows, {self.rate():.0f} rows/s {state}",
+            file=sys.stderr,
+            flush=True,
+        )
+
+
+async def connect() -> asyncpg.Connection:
+    # no prepared statements survive a transaction behind PgBouncer
+    options = {"statement_cache_size": 0} if PG_PGBOUNCER else {}
+    return await asyncpg.connect(
+        database_url().replace("+asyncpg", ""), **options
+    )
+
+
+def get_table(name: str) -> Table:
+    if name not in TABLES:
+        raise ValueError(f"Unsupported table {name!r}")
+    return Base.metadata.tables[name]
+
+
+def copy_columns(table: Table) -> List[Column]:
+    """Columns of table that can be written, i.e. not generated"""
+    return [column for column in table.columns if column.computed is None]
+
+
+def detect_format(path: str, fmt: Optional[str]) -> str:
+    if fmt:
+        return fmt
+    return "csv" if path.endswith(".csv") else "ndjson"
+
+
+async def export_table(
+    conn: asyncpg.Connection, name: str, fmt: str, output: BinaryIO
+) -> int:
+    """Write every row of a table to output in primary key order and
+    return how many were written"""
+    table = get_table(name)
+    columns = ", ".join(column.name for column in copy_columns(table))
+    order = ", ".join(column.name for column in table.primary_key.columns)
+    query = f"SELECT {columns} FROM {name} ORDER BY {order}"
+    progress = Progress(f"export {name}")
+
+    async def write(chunk: bytes) -> None:
+        output.write(chunk)
+        progress.add(chunk.count(b"\n"))
+
+    if fmt == "ndjson":
+        # row_to_json escapes every control character, so CSV with these
+        # as delimiter and quote never quotes and passes the JSON through
+        status = await conn.copy_from_query(
+            f"SELECT row_to_json(r) FROM ({query}) r",
+            output=write,
+            format="csv",
+            delimiter="\x02",
+            quote="\x01",
+        )
+    else:
+        status = await conn.copy_from_query(
+            query, output=write, format="csv", header=True
+        )
+    progress.rows = int(status.split()[-1])
+    progress.report(done=True)
+    return progress.rows
+
+
+def _lines(file: BinaryIO, offset: List[Offset]) -> Iterator[bytes]:
+    # offset[0] is the position after the last line read
+    for line in iter(file.readline, b""):
+        offset[0] = file.tell()
+        yield line
+
+
+def read_ndjson(
+    file: BinaryIO, start: Offset = 0
+) -> Iterator[Tuple[Offset, Dict]]:
+    """(offset after the row, row) of each row of an NDJSON file"""
+    offset = [start]
+    file.seek(start)
+    for line in _lines(file, offset):
+        if line.strip():
+            yield offset[0], orjson.loads(line)
+
+
+def read_csv(
+    file: BinaryIO, start: Offset = 0
+) -> Iterator[Tuple[Offset, Dict]]:
+    """(offset after the row, row) of each row of a CSV file with a header;
+    csv.reader pulls only the lines of the row it returns, so the offset
+    stays exact with quoted line breaks"""
+    offset = [0]
+    file.seek(0)
+    reader = csv.reader(line.decode() for line in _lines(file, offset))
+    header = next(reader, None)
+    if header is None:
+        return
+    if start > offset[0]:
+        file.seek(start)
+        offset[0] = start
+    for row in reader:
+        yield offset[0], dict(zip(header, row))
+
+
+def converter(column: Column, from_csv: bool) -> Callable[[Any], Any]:
+    """Function turning an input value into what COPY expects for column"""
+    python_type = column.type.python_type
+    parse = datetime.fromisoformat if python_type is datetime else python_type
+
+    def convert(value):
+        # CSV cannot tell NULL from an empty string
+        if value is None or (from_csv and value == "" and column.nullable):
+            return None
+        return parse(value) if isinstance(value, str) else value
+
+    return convert
+
+
+def load_checkpoint(path: Path, name: str) -> Tuple[Offset, int]:
+    if not path.exists():
+        return 0, 0
+    checkpoint = json.loads(path.read_text())
+    if checkpoint["table"] != name:
+        raise ValueError(f"{path} is a checkpoint of {checkpoint['table']}")
+    return checkpoint["offset"], checkpoint["rows"]
+
+
+def save_checkpoint(path: Path, name: str, offset: Offset, rows: int) -> None:
+    partial = path.with_name(path.name + ".partial")
+    partial.write_text(
+        json.dumps({"table": name, "offset": offset, "rows": rows})
+    )
+    os.replace(partial, path)
+
+
+async def _write_batch(
+    conn: asyncpg.Connection,
+    name: str,
+    staging: str,
+    columns: List[str],
+    records: List[Record],
+) -> None:
+    names = ", ".join(columns)
+    async with conn.transaction():
+        await conn.copy_records_to_table(
+            staging, records=records, columns=columns
+        )
+        await conn.execute(
+            f"INSERT INTO {name} ({names}) SELECT {names} FROM {staging} "
+            "ON CONFLICT DO NOTHING"
+        )
+
+
+async def import_table(
+    conn: asyncpg.Connection,
+    name: str,
+    path: str,
+    fmt: str,
+    checkpoint: Optional[Path] = None,
+    batch_size: int = BULK_BATCH_SIZE,
+) -> int:
+    """Copy the rows of a file into a table, resuming from and saving to
+    checkpoint; return the number of rows read in total"""
+    table = get_table(name)
+    writable = {column.name: column for column in copy_columns(table)}
+    start, rows = load_checkpoint(checkpoint, name) if checkpoint else (0, 0)
+    if rows:
+        print(f"resuming {name} after row {rows}", file=sys.stderr)
+    progress = Progress(f"import {name}", rows)
+    staging = f"bulk_{name}"
+    await conn.execute(
+        f"CREATE TEMPORARY TABLE IF NOT EXISTS {staging} "
+        f"(LIKE {name} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+    )
+    read = read_csv if fmt == "csv" else read_ndjson
+    columns: List[str] = []
+    converters: List[Callable] = []
+    batch: List[Record] = []
+    with open(path, "rb") as file:
+        for offset, row in read(file, start):
+            if not columns:
+                columns = [key for key in row if key in writable]
+                converters = [
+                    converter(writable[key], fmt == "csv") for key in columns
+                ]
+            batch.append(
+                tuple(
+                    convert(row.get(key))
+                    for key, convert in zip(columns, converters)
+                )
+            )
+            if len(batch) >= batch_size:
+                await _write_batch(conn, name, staging, columns, batch)
+                progress.add(len(batch))
+                batch = []
+                if checkpoint:
+                    save_checkpoint(checkpoint, name, offset, progress.rows)
+        if batch:
+            await _write_batch(conn, name, staging, columns, batch)
+            progress.add(len(batch))
+    progress.report(done=True)
+    if checkpoint:
+        checkpoint.unlink(missing_ok=True)
+    if "id" in columns:
+        await reset_sequence(conn, name)
+    return progress.rows
+
+
+async def reset_sequence(conn: asyncpg.Connection, name: str) -> None:
+    """Move the id sequence of a table past its largest id"""
+    await conn.execute(
+        f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), "
+        f"(SELECT coalesce(max(id), 0) + 1 FROM {name}), false)"
+    )
+
+
+def power_law(
+    rng: random.Random, count: int, exponent: float
+) -> Callable[[], int]:
+    """Draw ids 1..count, the id of popularity rank r with probability
+    roughly proportional to r ** -exponent, in constant memory: ranks come
+    from the inverse CDF of the continuous distribution and are spread
+    over the ids by a fixed permutation"""
+    stride = 1
+    while count > 1:
+        stride = rng.randrange(1, count)
+        if math.gcd(stride, count) == 1:
+            break
+    shift = rng.randrange(count)
+    power = 1 - exponent
+    top = (count + 1) ** power
+
+    def draw() -> int:
+        u = rng.random()
+        if power:
+            rank = (1 + u * (top - 1)) ** (1 / power)
+        else:
+            rank = (count + 1) ** u
+        rank = min(int(rank), count) - 1
+        return (rank * stride + shift) % count + 1
+
+    return draw
+
+
+def generated_rows(
+    options: argparse.Namespace,
+) -> Iterator[Tuple[str, List[str], Iterable[Record]]]:
+    """(table, columns, rows) of a synthetic dataset, in insertion order"""
+    users = options.users
+    tweets = int(users * options.tweets_per_user)
+
+    def rng(name: str) -> random.Random:
+        return random.Random(f"{options.seed}:{name}")
+
+    def user_rows():
+        for id in range(1, users + 1):
+            yield id, f"user{id}"
+
+    def key_rows():
+        for id in range(1, users + 1):
+            yield id, f"bench-{id}"
+
+    def follow_rows():
+        random = rng("follows")
+        draw = power_law(random, users, options.exponent)
+        for follower_id in range(1, users + 1):
+            wanted = 0
+            if options.follows_per_user:
+                wanted = int(random.expovariate(1 / options.follows_per_user))
+            followees = {draw() for _ in range(min(wanted, users - 1))}
+            followees.discard(follower_id)
+            for followee_id in followees:
+                yield followee_id, follower_id
+
+    def tweet_rows():
+        random = rng("tweets")
+        draw = power_law(random, users, options.exponent)
+        for id in range(1, tweets + 1):
+            words = random.choices(WORDS, k=random.randrange(3, 20))
+            yield id, " ".join(words), draw()
+
+    def like_rows():
+        random = rng("likes")
+        now = datetime.now(timezone.utc)
+        for tweet_id in range(1, tweets + 1):
+            # Pareto(1.5) less 1 has a mean of 2 and a heavy tail
+            wanted = options.likes_per_tweet * (random.paretovariate(1.5) - 1)
+            wanted = min(int(wanted / 2), users)
+            for user_id in random.sample(range(1, users + 1), wanted):
+                given = now - timedelta(seconds=random.random() * LIKE_SPREAD)
+                yield user_id, tweet_id, given
+
+    def media_rows():
+        random = rng("medias")
+        for tweet_id in range(1, tweets + 1):
+            if random.random() < options.media_share:
+                yield f"medias/seed/{tweet_id}.jpg", tweet_id
+
+    yield "users", ["id", "name"], user_rows()
+    yield "keys", ["user_id", "key"], key_rows()
+    yield "user_following", ["user_id", "follower_id"], follow_rows()
+    yield "tweets", ["id", "content", "author_id"], tweet_rows()
+    yield "likes", ["user_id", "tweet_id", "created_at"], like_rows()
+    yield "medias", ["link", "tweet_id"], media_rows()
+
+
+async def generate(
+    conn: asyncpg.Connection, options: argparse.Namespace
+) -> Dict[str, int]:
+    """Copy a synthetic dataset into empty tables; return the rows
+    written per table"""
+    counts = {}
+    for name, columns, rows in generated_rows(options):
+        progress = Progress(f"generate {name}")
+
+        def counted(rows=rows, progress=progress):
+            for row in rows:
+                progress.add(1)
+                yield row
+
+        await conn.copy_records_to_table(
+            name, records=counted(), columns=columns
+        )
+        progress.report(done=True)
+        counts[name] = progress.rows
+    for name in ("users", "keys", "tweets", "medias"):
+        await reset_sequence(conn, name)
+    return counts
+
+
+async def finish(tables: Iterable[str], timelines: bool) -> None:
+    """Recount likes and rebuild timelines after rows were written, without
+    the command timeout meant for requests"""
+    connect_args = engine_options()["connect_args"] | {"command_timeout": None}
+    bulk_engine = create_async_engine(
+        database_url(), poolclass=NullPool, connect_args=connect_args
+    )
+    async with async_sessionmaker(bind=bulk_engine)() as db:
+        if "likes" in tables:
+            print("recounting likes", file=sys.stderr)
+            await reconcile_like_counts(db)
+        if timelines:
+            print("rebuilding timelines", file=sys.stderr)
+            await rebuild_timelines(db)
+    await bulk_engine.dispose()
+
+
+async def run(args: argparse.Namespace) -> None:
+    conn = await connect()
+    start = time.perf_counter()
+    try:
+        if args.command == "export":
+            fmt = detect_format(args.output, args.format)
+            if args.output == "-":
+                await export_table(conn, args.table, fmt, sys.stdout.buffer)
+            else:
+                with open(args.output, "wb") as output:
+                    await export_table(conn, args.table, fmt, output)
+            return
+        if args.command == "import":
+            checkpoint = Path(args.checkpoint or f"{args.input}.checkpoint")
+            await import_table(
+                conn,
+                args.table,
+                args.input,
+                detect_format(args.input, args.format),
+                checkpoint,
+                args.batch_size,
+            )
+            tables = [args.table]
+        else:
+            if args.reset:
+                await conn.execute(
+                    f"TRUNCATE {', '.join(GENERATED_TABLES)} "
+                    "RESTART IDENTITY CASCADE"
+                )
+            counts = await generate(conn, args)
+            tables = list(counts)
+    finally:
+        await conn.close()
+    await finish(tables, args.timelines)
+    print(f"finished in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.bulk")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="write a table to a file")
+    export.add_argument("table", choices=TABLES)
+    export.add_argument("-o", "--output", default="-")
+    export.add_argument("--format", choices=("ndjson", "csv"))
+
+    load = commands.add_parser("import", help="copy a file into a table")
+    load.add_argument("table", choices=TABLES)
+    load.add_argument("input")
+    load.add_argument("--format", choices=("ndjson", "csv"))
+    load.add_argument("--checkpoint", help="default: <input>.checkpoint")
+    load.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+
+    generate = commands.add_parser(
+        "generate", help="fill empty tables with a benchmark dataset"
+    )
+    generate.add_argument("--users", type=int, default=100000)
+    generate.add_argument("--tweets-per-user", type=float, default=10)
+    generate.add_argument("--follows-per-user", type=float, default=20)
+    generate.add_argument("--likes-per-tweet", type=float, default=3)
+    generate.add_argument("--media-share", type=float, default=0.2)
+    generate.add_argument("--exponent", type=float, default=1.1)
+    generate.add_argument("--seed", type=int, default=0)
+    generate.add_argument(
+        "--reset", action="store_true", help="empty every table first"
+    )
+
+    for command in (load, generate):
+        command.add_argument(
+            "--timelines",
+            action="store_true",
+            help="rebuild home timelines afterwards (TIMELINE_ENABLED=1)",
+        )
+    export.set_defaults(timelines=False)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
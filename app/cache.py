@@ -0,0 +1,152 @@
+import fnmatch
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Hashable, Optional, Tuple
+
+# backend of the caches shared between workers, see create_backend
+CACHE_URL = os.environ.get("CACHE_URL")
+
+
+class LRUCache:
+    """Bounded in-process mapping with least-recently-used eviction and a
+    per-entry time to live"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Return (found, value); expired entries count as misses"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self._entries[key]
+        self.misses += 1
+        return False, None
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class MemoryBackend:
+    """Cache backend local to the worker process"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self.cache.get(key)[1]
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        self.cache.set(key, value, ttl)
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self.cache.invalidate(key)
+
+    async def clear(self) -> None:
+        self.cache.clear()
+
+
+class RedisBackend:
+    """Cache backend shared by every worker, storing JSON in Redis.
+
+    client is a redis.asyncio.Redis or anything with the same get, set and
+    delete coroutines and scan_iter, such as LocalRedis."""
+
+    def __init__(self, client, prefix: str = "microblog:", ttl: float = 300):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expire = math.ceil(self.ttl if ttl is None else ttl)
+        await self.client.set(self.prefix + key, json.dumps(value), ex=expire)
+
+    async def delete(self, *keys: str) -> None:
+        if keys:
+            await self.client.delete(*(self.prefix + key for key in keys))
+
+    async def clear(self) -> None:
+        """Delete every key under the prefix of this backend"""
+        keys = [key async for key in self.client.scan_iter(self.prefix + "*")]
+        if keys:
+            await self.client.delete(*keys)
+
+
+class LocalRedis:
+    """In-process stand-in for the subset of the redis.asyncio client used by
+    RedisBackend"""
+
+    def __init__(self):
+        self._values: Dict[str, Tuple[Optional[float], bytes]] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        expires_at, value = self._values.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._values[key]
+            return None
+        return value
+
+    async def set(self, key: str, value, ex: Optional[int] = None) -> bool:
+        if isinstance(value, str):
+            value = value.encode()
+        expires_at = None if ex is None else time.monotonic() + ex
+        self._values[key] = (expires_at, value)
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self._values.pop(key, None) is not None for key in keys)
+
+    async def scan_iter(self, match: str = "*") -> AsyncIterator[str]:
+        for key in list(self._values):
+            if fnmatch.fnmatchcase(key, match):
+                yield key
+
+
+def create_backend(url: Optional[str], ttl: float, prefix: str = "microblog:"):
+    """Backend for a CACHE_URL: empty for the in-process cache, redis://...
+    for a shared Redis (needs the optional `redis` package) or local:// for
+    LocalRedis; prefix namespaces the keys in Redis"""
+    if not url:
+        return MemoryBackend(ttl=ttl)
+    if url.startswith("local://"):
+        return RedisBackend(LocalRedis(), prefix, ttl)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            from redis import asyncio as redis  # type: ignore[import-untyped]
+        except ImportError:
+            raise RuntimeError("CACHE_URL needs the redis package installed")
+        return RedisBackend(redis.from_url(url), prefix, ttl)
+    raise ValueError(f"Unsupported cache url {url!r}")
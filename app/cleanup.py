@@ -0,0 +1,272 @@
+"""Asynchronous removal of deleted tweets and abandoned uploads.
+
+delete_tweet_by_id only sets tweets.deleted_at, and every read path skips
+such tweets. A background task then reaps them CLEANUP_BATCH_SIZE at a time,
+one transaction per batch: likes, media rows (variants follow by ON DELETE
+CASCADE), timeline entries (likewise) and the tweets themselves. Uploads
+never attached to a tweet are swept the same way once they are older than
+MEDIA_ORPHAN_GRACE seconds.
+
+With TIMELINE_ENABLED=1 the task also trims the home timelines that tweets
+written since its previous run were fanned out to back to their newest
+TIMELINE_DEPTH entries. Only one process does this: the one holding a
+Postgres advisory lock, taken on a connection of its own which keeps it
+until the process exits. Its first run only notes the newest tweet; a
+timeline missed across a restart is trimmed with the next tweet it gets.
+
+Blobs are content-addressed and shared by every media row with the same
+content, so a file is removed only after the commit and only when no
+remaining row links to it. An upload of the same content touches the blob
+before inserting its row (see app.media), and blobs touched within
+BLOB_REUSE_WINDOW seconds are left alone, which closes the gap between the
+two.
+
+Batches are claimed with FOR UPDATE SKIP LOCKED, so the task can run in
+every worker. It can also be run once, e.g. from cron, with:
+
+    python -m app.cleanup
+
+which trims every timeline, CLEANUP_BATCH_SIZE users at a time.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Iterable, List, Optional, Set, Tuple
+
+import asyncpg  # type: ignore[import-untyped]
+from sqlalchemy import delete, func, select, union
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from starlette.concurrency import run_in_threadpool
+
+from app.database import Session as DBSession
+from app.database import database_url, engine
+from app.media import media_path
+from app.models import Media, MediaVariant, Tweet, likes_table
+from app.timeline import TIMELINE_ENABLED, trim_fanned_out, trim_timelines
+
+CLEANUP_ENABLED = os.environ.get("CLEANUP_ENABLED", "1") == "1"
+CLEANUP_INTERVAL = float(os.environ.get("CLEANUP_INTERVAL", 60))
+CLEANUP_BATCH_SIZE = int(os.environ.get("CLEANUP_BATCH_SIZE", 500))
+MEDIA_ORPHAN_GRACE = float(os.environ.get("MEDIA_ORPHAN_GRACE", 24 * 3600))
+BLOB_REUSE_WINDOW = 600
+# advisory lock of the process that trims timelines
+TIMELINE_TRIM_LOCK = 4_721_001
+
+logger = logging.getLogger(__name__)
+
+
+async def _delete_media(db: AsyncSession, media_ids: List[int]) -> Set[str]:
+    """Delete media rows with their variants and return the links of their
+    files"""
+    variant_links = await db.scalars(
+        select(MediaVariant.link).where(MediaVariant.media_id.in_(media_ids))
+    )
+    links = set(variant_links)
+    links.update(
+        await db.scalars(
+            delete(Media).where(Media.id.in_(media_ids)).returning(Media.link)
+        )
+    )
+    return links
+
+
+async def reap_tweets(
+    db: AsyncSession, batch_size: int = CLEANUP_BATCH_SIZE
+) -> Tuple[int, Set[str]]:
+    """Remove one batch of soft-deleted tweets with everything attached to
+    them and commit; return how many were removed and the links of the
+    media files they used"""
+    tweet_ids = list(
+        await db.scalars(
+            select(Tweet.id)
+            .where(Tweet.deleted_at.is_not(None))
+            .order_by(Tweet.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+    )
+    if not tweet_ids:
+        return 0, set()
+    await db.execute(
+        delete(likes_table).where(likes_table.c.tweet_id.in_(tweet_ids))
+    )
+    media_ids = list(
+        await db.scalars(select(Media.id).where(Media.tweet_id.in_(tweet_ids)))
+    )
+    links = await _delete_media(db, media_ids) if media_ids else set()
+    await db.execute(delete(Tweet).where(Tweet.id.in_(tweet_ids)))
+    await db.commit()
+    logger.info("Reaped %d deleted tweets", len(tweet_ids))
+    return len(tweet_ids), links
+
+
+async def sweep_orphan_media(
+    db: AsyncSession,
+    grace: float = MEDIA_ORPHAN_GRACE,
+    batch_size: int = CLEANUP_BATCH_SIZE,
+) -> Tuple[int, Set[str]]:
+    """Remove one batch of uploads older than grace seconds that no tweet
+    uses and commit; return how many were removed and the links of their
+    files"""
+    media_ids = list(
+        await db.scalars(
+            select(Media.id)
+            .where(
+                Media.tweet_id.is_(None),
+                Media.created_at < func.now() - timedelta(seconds=grace),
+            )
+            .order_by(Media.created_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+    )
+    if not media_ids:
+        return 0, set()
+    links = await _delete_media(db, media_ids)
+    await db.commit()
+    logger.info("Swept %d orphan uploads", len(media_ids))
+    return len(media_ids), links
+
+
+def _unlink_stale(links: Iterable[str], min_age: float) -> int:
+    removed = 0
+    now = time.time()
+    for link in links:
+        path = media_path(link)
+        try:
+            if now - path.stat().st_mtime < min_age:
+                continue
+            path.unlink()
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+async def remove_files(db: AsyncSession, links: Set[str]) -> int:
+    """Delete the files of links that no media row or variant uses any more
+    and return how many were deleted"""
+    if not links:
+        return 0
+    used = await db.scalars(
+        union(
+            select(Media.link).where(Media.link.in_(links)),
+            select(MediaVariant.link).where(MediaVariant.link.in_(links)),
+        )
+    )
+    unused = links - set(used)
+    await db.rollback()
+    return await run_in_threadpool(_unlink_stale, unused, BLOB_REUSE_WINDOW)
+
+
+async def clean_up(
+    session_factory: async_sessionmaker = DBSession,
+    batch_size: int = CLEANUP_BATCH_SIZE,
+) -> int:
+    """Reap deleted tweets and sweep orphan uploads until nothing is left;
+    return the number of files deleted"""
+    removed = 0
+    for step in (reap_tweets, sweep_orphan_media):
+        count = batch_size
+        while count == batch_size:
+            async with session_factory() as db:
+                count, links = await step(db, batch_size=batch_size)
+                removed += await remove_files(db, links)
+    return removed
+
+
+class Cleaner:
+    """Background task running clean_up every CLEANUP_INTERVAL seconds"""
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker = DBSession,
+        interval: float = CLEANUP_INTERVAL,
+    ):
+        self.session_factory = session_factory
+        self.interval = interval
+        # newest tweet whose timelines are trimmed, once this process leads
+        self.trimmed: Optional[int] = None
+        self._lock = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def _lead(self) -> bool:
+        """Whether this process holds the timeline trim lock, trying to take
+        it if not"""
+        if self._lock is not None and not self._lock.is_closed():
+            return True
+        self._lock = self.trimmed = None
+        # the lock lives as long as its session, so not through PgBouncer
+        connection = await asyncpg.connect(
+            database_url().replace("+asyncpg", "")
+        )
+        if await connection.fetchval(
+            "SELECT pg_try_advisory_lock($1)", TIMELINE_TRIM_LOCK
+        ):
+            self._lock = connection
+            return True
+        await connection.close()
+        return False
+
+    async def trim(self) -> None:
+        """Trim the timelines fanned out to since the previous call, if this
+        process leads"""
+        if not await self._lead():
+            return
+        async with self.session_factory() as db:
+            trimmed = await trim_fanned_out(db, self.trimmed)
+            await db.commit()
+        self.trimmed = trimmed
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await clean_up(self.session_factory)
+                if TIMELINE_ENABLED:
+                    await self.trim()
+            except Exception:
+                logger.exception("Cleanup failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._lock is not None:
+            await self._lock.close()
+            self._lock = None
+
+
+cleaner = Cleaner()
+
+
+async def clean_up_once(batch_size: int) -> None:
+    removed = await clean_up(batch_size=batch_size)
+    after = 0 if TIMELINE_ENABLED else None
+    while after is not None:
+        async with DBSession() as db:
+            after = await trim_timelines(db, after, batch_size)
+    await engine.dispose()
+    print(f"{removed} files deleted")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.cleanup")
+    parser.add_argument("--batch-size", type=int, default=CLEANUP_BATCH_SIZE)
+    args = parser.parse_args()
+    asyncio.run(clean_up_once(args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
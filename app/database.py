@@ -1,27 +1,218 @@
+import itertools
+import logging
 import os
-from typing import Any, Dict
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import DeclarativeBase, sessionmaker
+from fastapi import Request
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import Session as SyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
+
+from app.cache import CACHE_URL, create_backend
 
 PG_USER = os.environ.get("PG_USER")
 PG_PASSWORD = os.environ.get("PG_PASSWORD")
 PG_HOST = os.environ.get("PG_HOST")
 PG_DATABASE = os.environ.get("PG_DATABASE")
 
-engine = create_engine(
-    f"postgresql+psycopg2://{PG_USER}:{PG_PASSWORD}@{PG_HOST}/{PG_DATABASE}",
-    pool_pre_ping=True,
-)
-Session = sessionmaker(bind=engine)
+PG_POOL_SIZE = int(os.environ.get("PG_POOL_SIZE", 5))
+PG_MAX_OVERFLOW = int(os.environ.get("PG_MAX_OVERFLOW", 10))
+PG_POOL_TIMEOUT = float(os.environ.get("PG_POOL_TIMEOUT", 30))
+PG_COMMAND_TIMEOUT = float(os.environ.get("PG_COMMAND_TIMEOUT", 60))
+# connections all workers together may open; 0 keeps PG_POOL_SIZE and
+# PG_MAX_OVERFLOW as they are
+PG_CONNECTION_BUDGET = int(os.environ.get("PG_CONNECTION_BUDGET", 0))
+# PgBouncer in transaction pooling mode: it pools the connections, and
+# prepared statements cannot outlive a transaction
+PG_PGBOUNCER = os.environ.get("PG_PGBOUNCER") == "1"
+# worker processes serving the app, set by app/gunicorn.conf.py
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+# comma separated SQLAlchemy URLs of read replicas
+PG_REPLICA_URLS = [
+    url.strip()
+    for url in os.environ.get("PG_REPLICA_URLS", "").split(",")
+    if url.strip()
+]
+# seconds after a write during which the reads of that client stay on the
+# primary
+READ_YOUR_WRITES_WINDOW = float(os.environ.get("READ_YOUR_WRITES_WINDOW", 5))
+# seconds a replica that failed to connect is left out of the rotation
+REPLICA_RETRY_INTERVAL = float(os.environ.get("REPLICA_RETRY_INTERVAL", 10))
+# weight of the last checkout in the moving average of pool wait time, and
+# seconds without checkouts after which the average no longer counts
+POOL_WAIT_SMOOTHING = 0.2
+POOL_WAIT_WINDOW = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+def database_url(driver: str = "asyncpg") -> str:
+    return (
+        f"postgresql+{driver}://{PG_USER}:{PG_PASSWORD}@{PG_HOST}/{PG_DATABASE}"
+    )
+
+
+def pool_limits(workers: int, budget: int) -> Tuple[int, int]:
+    """pool_size and max_overflow of one worker, so that all workers stay
+    within budget connections; two thirds of a share are kept open"""
+    if not budget:
+        return PG_POOL_SIZE, PG_MAX_OVERFLOW
+    share = max(1, budget // max(1, workers))
+    pool_size = max(1, share * 2 // 3)
+    return pool_size, share - pool_size
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool keeping a moving average of how long checkouts wait for
+    a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_time = 0.0
+        self.waited_at = 0.0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            self.waited_at = time.monotonic()
+            self.wait_time += (
+                self.waited_at - start - self.wait_time
+            ) * POOL_WAIT_SMOOTHING
+
+
+def engine_options() -> Dict[str, Any]:
+    connect_args: Dict[str, Any] = {"command_timeout": PG_COMMAND_TIMEOUT}
+    if PG_PGBOUNCER:
+        connect_args |= {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+        }
+        return {"poolclass": NullPool, "connect_args": connect_args}
+    pool_size, max_overflow = pool_limits(WEB_CONCURRENCY, PG_CONNECTION_BUDGET)
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_pre_ping": True,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": PG_POOL_TIMEOUT,
+        "connect_args": connect_args,
+    }
+
+
+# created on import, so every worker process gets its own pool
+engine = create_async_engine(database_url(), **engine_options())
+Session = async_sessionmaker(bind=engine, expire_on_commit=False)
+replica_engines: List[AsyncEngine] = [
+    create_async_engine(url, **engine_options()) for url in PG_REPLICA_URLS
+]
+# monotonic time until which a replica is skipped, by replica index
+replica_down_until: Dict[int, float] = {}
+_next_replica = itertools.count()
+# api keys that wrote within READ_YOUR_WRITES_WINDOW
+recent_writers = create_backend(CACHE_URL, ttl=READ_YOUR_WRITES_WINDOW)
+
+
+def pool_wait() -> float:
+    """Recent average checkout wait in seconds of the busiest pool; 0 once
+    no connection was checked out for POOL_WAIT_WINDOW seconds"""
+    now = time.monotonic()
+    return max(
+        (
+            pool.wait_time
+            for pool in (e.pool for e in (engine, *replica_engines))
+            if isinstance(pool, TimedQueuePool)
+            and now - pool.waited_at < POOL_WAIT_WINDOW
+        ),
+        default=0.0,
+    )
+
+
+def _writer_key(request: Request) -> Optional[str]:
+    api_key = request.headers.get("api-key")
+    return f"writer:{api_key}" if api_key else None
+
+
+async def get_db(request: Request):
+    """Session on the primary, for requests that write"""
+    writer = _writer_key(request)
+    if writer and replica_engines:
+        await recent_writers.set(writer, True)
+    async with Session() as db:
+        yield db
+
+
+async def get_primary_db():
+    """Session on the primary, for reads that fill caches shared by every
+    client and so must not see a lagging replica"""
+    async with Session() as db:
+        yield db
+
+
+def _next_healthy_replica() -> Optional[int]:
+    for _ in range(len(replica_engines)):
+        number = next(_next_replica) % len(replica_engines)
+        if replica_down_until.get(number, 0) <= time.monotonic():
+            return number
+    return None
+
+
+class ReplicaSession(SyncSession):
+    """Session bound to the replica info["replica"], connecting on its first
+    query like any session. When the replica cannot be connected to, it is
+    left out for REPLICA_RETRY_INTERVAL and the session moves on to the next
+    healthy replica, or else to info["primary"]."""
+
+    def _connection_for_bind(self, bind, execution_options=None, **kw):
+        while True:
+            try:
+                return super()._connection_for_bind(
+                    bind, execution_options, **kw
+                )
+            except (DBAPIError, OSError) as e:
+                number = self.info.get("replica")
+                if number is None:
+                    raise
+                replica_down_until[number] = (
+                    time.monotonic() + REPLICA_RETRY_INTERVAL
+                )
+                logger.warning("Replica %s is unavailable: %r", number, e)
+                number = self.info["replica"] = _next_healthy_replica()
+                if number is None:
+                    bind = self.info["primary"].sync_engine
+                else:
+                    bind = replica_engines[number].sync_engine
+                self.bind = bind
 
 
-def get_db():
-    db = Session()
-    try:
+async def get_read_db(request: Request):
+    """Session on a replica, or on the primary when there is no healthy
+    replica or the client wrote within READ_YOUR_WRITES_WINDOW. Nothing
+    connects before the first query."""
+    number = None
+    writer = _writer_key(request)
+    if replica_engines and not (writer and await recent_writers.get(writer)):
+        number = _next_healthy_replica()
+    if number is None:
+        db = Session()
+    else:
+        db = Session(
+            bind=replica_engines[number],
+            sync_session_class=ReplicaSession,
+            info={"replica": number, "primary": Session.kw["bind"]},
+        )
+    async with db:
         yield db
-    finally:
-        db.close()
 
 
 class Base(DeclarativeBase):
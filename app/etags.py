@@ -0,0 +1,112 @@
+"""Weak ETags for the feed and profile responses.
+
+Each cacheable scope has a version token kept in the CACHE_URL backend:
+
+- "feed": any tweet or like; the ranked feed is global;
+- "following:<user_id>": the follows made by the user;
+- "profile:<user_id>": follows made by or to the user.
+
+Writes replace the tokens of the scopes they touch after commit (bump).
+The ETag of a response is derived from the tokens read before its queries
+and the request parameters, so a GET with a matching If-None-Match gets a
+304 after the auth lookup and without any feed or profile query.
+
+Tokens are random rather than counted: a token that expires from the cache
+is replaced by a new one, which can never match an ETag handed out before.
+
+A bump is visible at once while read replicas may still lag behind the
+write, so a page read from one could be stored by the client under the new
+ETag and then be answered with 304 until the next write. For
+READ_YOUR_WRITES_WINDOW seconds after a bump the scope therefore reads from
+the primary (see bumped_recently).
+With several workers tokens must be shared, so ETags are off by default
+unless CACHE_URL is set or there is a single worker.
+"""
+
+import hashlib
+import os
+import uuid
+from typing import Optional
+
+from fastapi import Request
+
+from app.cache import CACHE_URL, create_backend
+from app.database import (
+    READ_YOUR_WRITES_WINDOW,
+    WEB_CONCURRENCY,
+    replica_engines,
+)
+
+ETAGS_ENABLED = (
+    os.environ.get(
+        "ETAGS_ENABLED", "1" if CACHE_URL or WEB_CONCURRENCY == 1 else "0"
+    )
+    == "1"
+)
+ETAG_VERSION_TTL = float(os.environ.get("ETAG_VERSION_TTL", 24 * 3600))
+
+versions = create_backend(CACHE_URL, ttl=ETAG_VERSION_TTL)
+# scopes bumped within READ_YOUR_WRITES_WINDOW
+recent_bumps = create_backend(CACHE_URL, ttl=READ_YOUR_WRITES_WINDOW)
+
+
+def _key(scope: str) -> str:
+    return f"version:{scope}"
+
+
+async def bump(*scopes: str) -> None:
+    """Invalidate the ETags of scopes; call after the write is committed"""
+    if not ETAGS_ENABLED:
+        return
+    for scope in scopes:
+        await versions.set(_key(scope), uuid.uuid4().hex)
+        if replica_engines:
+            await recent_bumps.set(_key(scope), True)
+
+
+async def bumped_recently(*scopes: str) -> bool:
+    """Whether any of scopes was bumped within READ_YOUR_WRITES_WINDOW, so
+    that a response sent with their ETag must be read from the primary"""
+    if not (ETAGS_ENABLED and replica_engines):
+        return False
+    for scope in scopes:
+        if await recent_bumps.get(_key(scope)):
+            return True
+    return False
+
+
+async def _token(scope: str) -> str:
+    token = await versions.get(_key(scope))
+    if token is None:
+        token = uuid.uuid4().hex
+        await versions.set(_key(scope), token)
+    return token
+
+
+async def make_etag(scopes, *params) -> Optional[str]:
+    """Weak ETag of a response built from scopes with params, or None if
+    ETags are disabled"""
+    if not ETAGS_ENABLED:
+        return None
+    tokens = [await _token(scope) for scope in scopes]
+    digest = hashlib.blake2b(
+        repr((tokens, params)).encode(), digest_size=12
+    ).hexdigest()
+    return f'W/"{digest}"'
+
+
+def not_modified(request: Request, etag: Optional[str]) -> bool:
+    """Whether If-None-Match of the request matches etag (weak
+    comparison)"""
+    if etag is None:
+        return False
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(
+        candidate.strip().removeprefix("W/") == opaque
+        for candidate in header.split(",")
+    )
@@ -0,0 +1,216 @@
+"""Live feed events for GET /api/tweets/stream.
+
+Writers publish small events after commit:
+
+    {"type": "tweet", "tweet_id": 7, "author_id": 2}
+    {"type": "like", "tweet_id": 7, "author_id": 2, "delta": 1}
+
+and the bus hands them to the subscriptions of this worker: both go to the
+followers of the author of the tweet and to the author. With
+EVENTS_NOTIFY_ENABLED=1 events are sent through Postgres NOTIFY instead and
+every worker LISTENs, so subscribers connected to any worker receive them.
+A dropped LISTEN connection is reconnected, and since events may have been
+missed meanwhile every subscription then gets a "resync".
+
+Every subscription has a bounded queue. A client too slow to drain it
+loses its queued events and gets a single "resync" event asking it to
+reload the feed, so one stalled client never holds memory or slows the
+publishers. STREAM_MAX_CONNECTIONS caps the subscriptions of a worker.
+
+LISTEN needs a session-level connection, so the bridge connects straight to
+Postgres even when PG_PGBOUNCER is set.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, FrozenSet, List, Optional, Set
+
+import asyncpg  # type: ignore[import-untyped]
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import database_url
+from app.follow_graph import following_cache
+from app.models import Tweet
+
+EVENTS_NOTIFY_ENABLED = os.environ.get("EVENTS_NOTIFY_ENABLED") == "1"
+EVENTS_CHANNEL = "microblog_events"
+STREAM_MAX_CONNECTIONS = int(os.environ.get("STREAM_MAX_CONNECTIONS", 1000))
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", 100))
+# seconds between keep-alive comments, which also detect gone clients
+STREAM_HEARTBEAT = float(os.environ.get("STREAM_HEARTBEAT", 15))
+# longest wait between attempts to reconnect the LISTEN connection
+LISTEN_RETRY_MAX = 30.0
+
+RESYNC = {"type": "resync"}
+
+logger = logging.getLogger(__name__)
+
+
+def like_event(tweet_id: int, author_id: int, delta: int) -> Dict:
+    return {
+        "type": "like",
+        "tweet_id": tweet_id,
+        "author_id": author_id,
+        "delta": delta,
+    }
+
+
+async def like_events(db: AsyncSession, deltas: Dict[int, int]) -> List[Dict]:
+    """Events for changes of the like counters of several tweets"""
+    if not deltas:
+        return []
+    authors = await db.execute(
+        select(Tweet.id, Tweet.author_id).where(Tweet.id.in_(deltas))
+    )
+    return [
+        like_event(tweet_id, author_id, deltas[tweet_id])
+        for tweet_id, author_id in authors
+    ]
+
+
+class Subscription:
+    def __init__(self, user_id: int, following: FrozenSet[int]):
+        self.user_id = user_id
+        self.following = following
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    def wants(self, event: Dict) -> bool:
+        if "author_id" not in event:
+            return True
+        # pick up follows made since subscribing once the follow graph of
+        # the user is loaded again
+        found, following = following_cache.get(self.user_id)
+        if found:
+            self.following = following
+        author_id = event["author_id"]
+        return author_id == self.user_id or author_id in self.following
+
+    def push(self, event: Dict) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+
+class EventBus:
+    def __init__(self):
+        self.subscriptions: Set[Subscription] = set()
+        self._publisher = None
+        self._listener = None
+        self._reconnect: Optional[asyncio.Task] = None
+
+    def full(self) -> bool:
+        return len(self.subscriptions) >= STREAM_MAX_CONNECTIONS
+
+    def subscribe(self, user_id: int, following: FrozenSet[int]):
+        subscription = Subscription(user_id, following)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.subscriptions.discard(subscription)
+
+    def deliver(self, event: Dict) -> None:
+        """Hand an event to the interested subscriptions of this worker"""
+        for subscription in list(self.subscriptions):
+            if subscription.wants(event):
+                subscription.push(event)
+
+    async def publish(self, event: Dict) -> None:
+        """Send an event to the subscribers of every worker; call after the
+        change it describes is committed"""
+        if self._publisher is not None:
+            try:
+                # pg_notify rather than NOTIFY, which takes no parameters
+                await self._publisher.execute(
+                    "SELECT pg_notify($1, $2)",
+                    EVENTS_CHANNEL,
+                    json.dumps(event),
+                )
+                return
+            except Exception:
+                logger.exception("NOTIFY failed, delivering locally")
+        self.deliver(event)
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        self.deliver(json.loads(payload))
+
+    async def _listen(self) -> None:
+        connection = await asyncpg.connect(
+            database_url().replace("+asyncpg", "")
+        )
+        await connection.add_listener(EVENTS_CHANNEL, self._on_notify)
+        connection.add_termination_listener(self._on_terminate)
+        self._listener = connection
+
+    def _on_terminate(self, connection) -> None:
+        # also called by close(), after stop() has let go of the connection
+        if connection is not self._listener:
+            return
+        logger.warning("LISTEN connection lost, reconnecting")
+        self._listener = None
+        self._reconnect = asyncio.create_task(self._relisten())
+
+    async def _relisten(self) -> None:
+        delay = 0.5
+        while True:
+            try:
+                await self._listen()
+                break
+            except Exception:
+                logger.exception("LISTEN reconnect failed")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, LISTEN_RETRY_MAX)
+        self._reconnect = None
+        for subscription in list(self.subscriptions):
+            subscription.push(RESYNC)
+
+    async def start(self) -> None:
+        """Connect the LISTEN/NOTIFY bridge"""
+        await self._listen()
+        self._publisher = await asyncpg.create_pool(
+            database_url().replace("+asyncpg", ""), min_size=1, max_size=2
+        )
+
+    async def stop(self) -> None:
+        if self._reconnect is not None:
+            self._reconnect.cancel()
+            self._reconnect = None
+        connections = (self._publisher, self._listener)
+        self._publisher = self._listener = None
+        for connection in connections:
+            if connection is not None:
+                await connection.close()
+
+
+async def event_stream(user_id: int, following: FrozenSet[int]):
+    """Server-sent events for a user, until the client leaves; subscribes
+    on the first iteration, so a response never sent leaves nothing
+    behind"""
+    subscription = bus.subscribe(user_id, following)
+    sequence = 0
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(
+                    subscription.queue.get(), timeout=STREAM_HEARTBEAT
+                )
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            sequence += 1
+            yield (
+                f"id: {sequence}\nevent: {event['type']}\n"
+                f"data: {json.dumps(event)}\n\n"
+            )
+    finally:
+        bus.unsubscribe(subscription)
+
+
+bus = EventBus()
@@ -0,0 +1,148 @@
+import base64
+import binascii
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+from sqlalchemy import (
+    ARRAY,
+    Integer,
+    SQLColumnExpression,
+    all_,
+    any_,
+    column,
+    literal,
+    select,
+    tuple_,
+    union_all,
+    values,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.follow_graph import get_following
+from app.loaders import load_tweets
+from app.models import Tweet
+from app.trending import TRENDING_ENABLED, trending
+
+FEED_PAGE_SIZE = 50
+FEED_MAX_PAGE_SIZE = 100
+
+Cursor = Tuple[int, int, int]
+
+# tiers of the ranked feed, best first
+FOLLOWED, TRENDING, OTHERS = 1, 0, -1
+
+
+def encode_cursor(
+    tier: int, rank: int, tweet_id: int, snapshot: int = 0
+) -> str:
+    """Pack the sort key of the last tweet on a page, and the version of the
+    trending snapshot the page was ranked with, into an opaque token"""
+    raw = f"{tier}.{rank}.{tweet_id}.{snapshot}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Cursor, Optional[int]]:
+    """Unpack a token produced by encode_cursor; tokens handed out before
+    they carried a snapshot version have none"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        parts = [int(part) for part in raw.split(".")]
+        snapshot = parts.pop() if len(parts) == 4 else None
+        tier, rank, tweet_id = parts
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+    return (tier, rank, tweet_id), snapshot
+
+
+def ranked_feed_query(
+    following: FrozenSet[int],
+    limit: int,
+    cursor: Optional[Cursor] = None,
+    trending: Sequence[int] = (),
+):
+    """Select one page of tweet ids ranked by "followed authors first, then
+    trending tweets, then by like count", newest first on ties.
+
+    Each tier is ranked in its own branch, so the branches of followed and
+    of other authors can walk the (like_count, id) index and stop after
+    `limit` rows; only `limit` rows ever leave Postgres. Trending tweets
+    keep the order of `trending`, which holds their ids best first.
+    """
+    followed_authors = literal(sorted(following), ARRAY(Integer))
+    trending_ids = literal(list(trending), ARRAY(Integer))
+    branches = []
+    rank: SQLColumnExpression[int]
+    order: Tuple[SQLColumnExpression[int], ...]
+    for tier in (FOLLOWED, TRENDING, OTHERS):
+        if tier == FOLLOWED and not following:
+            continue
+        if tier == TRENDING and not trending:
+            continue
+        if cursor is not None and tier > cursor[0]:
+            continue
+        if tier == TRENDING:
+            positions = values(
+                column("id", Integer),
+                column("position", Integer),
+                name="trending",
+            ).data([(id, position) for position, id in enumerate(trending)])
+            rank = -positions.c.position
+            branch = (
+                select(
+                    Tweet.id, literal(tier).label("tier"), rank.label("rank")
+                )
+                .join(positions, positions.c.id == Tweet.id)
+                .where(Tweet.author_id != all_(followed_authors))
+            )
+            order = (positions.c.position, Tweet.id.desc())
+        else:
+            rank = Tweet.like_count
+            branch = select(
+                Tweet.id, literal(tier).label("tier"), rank.label("rank")
+            ).where(
+                Tweet.author_id == any_(followed_authors)
+                if tier == FOLLOWED
+                else Tweet.author_id != all_(followed_authors)
+            )
+            if tier == OTHERS and trending:
+                branch = branch.where(Tweet.id != all_(trending_ids))
+            order = (Tweet.like_count.desc(), Tweet.id.desc())
+        branch = branch.where(Tweet.deleted_at.is_(None))
+        if cursor is not None and tier == cursor[0]:
+            after = tuple_(literal(cursor[1]), literal(cursor[2]))
+            branch = branch.where(tuple_(rank, Tweet.id) < after)
+        branches.append(branch.order_by(*order).limit(limit))
+
+    page = union_all(*branches).subquery()
+    return (
+        select(page)
+        .order_by(page.c.tier.desc(), page.c.rank.desc(), page.c.id.desc())
+        .limit(limit)
+    )
+
+
+async def get_feed_page(
+    db: AsyncSession, user_id: int, limit: int, cursor: Optional[str] = None
+) -> Tuple[List[Dict], Optional[str]]:
+    """Return one page of the feed and the cursor of the next page"""
+    limit = max(1, min(limit, FEED_MAX_PAGE_SIZE))
+    position, snapshot = decode_cursor(cursor) if cursor else (None, None)
+    following = await get_following(db, user_id)
+    # every page of a walk is ranked with the snapshot of its first page, or
+    # tweets entering or leaving the top would be repeated or skipped
+    snapshot, top = (
+        await trending.pinned(snapshot) if TRENDING_ENABLED else (0, ())
+    )
+    rows = (
+        await db.execute(ranked_feed_query(following, limit, position, top))
+    ).all()
+    if not rows:
+        return [], None
+
+    page = await load_tweets(db, [row.id for row in rows])
+
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = encode_cursor(last.tier, last.rank, last.id, snapshot)
+    return page, next_cursor
@@ -0,0 +1,41 @@
+"""Cached adjacency of the follow graph.
+
+"Who does user X follow" is loaded once as a frozenset and kept in an
+in-process LRU cache, so membership checks in feed ranking are O(1).
+follow_user/unfollow_user invalidate the follower's entry after commit;
+other workers pick the change up when their entry expires.
+"""
+
+import os
+from typing import FrozenSet
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.cache import LRUCache
+from app.models import user_following
+
+FOLLOW_GRAPH_CACHE_SIZE = int(os.environ.get("FOLLOW_GRAPH_CACHE_SIZE", 10000))
+FOLLOW_GRAPH_CACHE_TTL = float(os.environ.get("FOLLOW_GRAPH_CACHE_TTL", 60))
+
+# follower id -> ids of the users they follow
+following_cache = LRUCache(
+    maxsize=FOLLOW_GRAPH_CACHE_SIZE, ttl=FOLLOW_GRAPH_CACHE_TTL
+)
+
+
+async def get_following(db: AsyncSession, user_id: int) -> FrozenSet[int]:
+    """Ids of the users followed by user_id"""
+    found, following = following_cache.get(user_id)
+    if not found:
+        query = select(user_following.c.user_id).where(
+            user_following.c.follower_id == user_id
+        )
+        following = frozenset(await db.scalars(query))
+        following_cache.set(user_id, following)
+    return following
+
+
+def invalidate_following(user_id: int) -> None:
+    """Must be called after a follow edge of user_id is committed"""
+    following_cache.invalidate(user_id)
@@ -0,0 +1,26 @@
+"""Production server settings: gunicorn -c app/gunicorn.conf.py app.main:app
+
+Runs WEB_CONCURRENCY uvicorn workers (one per core by default), each on
+uvloop and httptools. The app is imported by every worker after the fork,
+so each worker creates its own engine and sizes its pool from
+WEB_CONCURRENCY and PG_CONNECTION_BUDGET (see app/database.py).
+"""
+
+import multiprocessing
+import os
+
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# read by app/database.py in the workers to split the connection budget
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+bind = os.environ.get("BIND", "0.0.0.0:80")
+worker_class = "uvicorn.workers.UvicornWorker"
+# importing the app in the master would create one engine shared by forks
+preload_app = False
+timeout = int(os.environ.get("WORKER_TIMEOUT", 60))
+graceful_timeout = 30
+keepalive = 5
+# recycle workers now and then to bound memory growth
+max_requests = int(os.environ.get("MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+accesslog = "-"
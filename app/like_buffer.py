@@ -0,0 +1,230 @@
+"""Write-behind buffer for like toggles.
+
+With LIKE_BUFFER_ENABLED=1 add_like/delete_like only record the wanted
+state of a (user, tweet) pair in memory and answer at once. Repeated
+toggles of a pair collapse into the last one, and a background task writes
+the net changes in a few statements whenever LIKE_BUFFER_MAX_SIZE pairs
+are pending or LIKE_BUFFER_FLUSH_INTERVAL seconds have passed. The lifespan
+of the app stops the task with a final flush.
+
+Feed payloads merge the pending state of this worker, so users see their
+own likes immediately; other workers see them after the next flush. Feed
+ranking keeps using tweets.like_count, which moves on flush.
+
+Writes that go straight to the likes table, like the batch endpoint, take
+the pending pairs they touch with `taking` and write them first in their
+own transaction, so a buffered toggle never lands after them.
+"""
+
+import asyncio
+import logging
+import os
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import Integer, column, delete, select, tuple_, update, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.database import Session as DBSession
+from app.etags import bump
+from app.events import bus, like_events
+from app.models import Tweet, User, likes_table
+
+LIKE_BUFFER_ENABLED = os.environ.get("LIKE_BUFFER_ENABLED") == "1"
+LIKE_BUFFER_MAX_SIZE = int(os.environ.get("LIKE_BUFFER_MAX_SIZE", 1000))
+LIKE_BUFFER_FLUSH_INTERVAL = float(
+    os.environ.get("LIKE_BUFFER_FLUSH_INTERVAL", 1.0)
+)
+
+logger = logging.getLogger(__name__)
+
+Pair = Tuple[int, int]
+
+
+class LikeBuffer:
+    """Pending like state keyed by (user_id, tweet_id); True means liked"""
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker = DBSession,
+        max_size: int = LIKE_BUFFER_MAX_SIZE,
+        flush_interval: float = LIKE_BUFFER_FLUSH_INTERVAL,
+    ):
+        self.session_factory = session_factory
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.pending: Dict[Pair, bool] = {}
+        # pairs taken by a running flush, still visible to readers
+        self.flushing: Dict[Pair, bool] = {}
+        self._wakeup = asyncio.Event()
+        # held by a flush and by the callers of taking
+        self._writing = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def like(self, user_id: int, tweet_id: int) -> None:
+        self._toggle(user_id, tweet_id, True)
+
+    def unlike(self, user_id: int, tweet_id: int) -> None:
+        self._toggle(user_id, tweet_id, False)
+
+    def _toggle(self, user_id: int, tweet_id: int, liked: bool) -> None:
+        self.pending[(user_id, tweet_id)] = liked
+        if len(self.pending) >= self.max_size:
+            self._wakeup.set()
+
+    def state(self, tweet_ids: List[int]) -> Dict[Pair, bool]:
+        """Unflushed state of the pairs of tweet_ids"""
+        wanted = set(tweet_ids)
+        merged = self.flushing | self.pending
+        return {
+            pair: liked for pair, liked in merged.items() if pair[1] in wanted
+        }
+
+    async def flush(self) -> int:
+        """Write every pending pair and return how many were written"""
+        if not self.pending or self.flushing:
+            return 0
+        async with self._writing:
+            self.flushing, self.pending = self.pending, {}
+            try:
+                async with self.session_factory() as db:
+                    deltas = await write_likes(db, self.flushing)
+                    await db.commit()
+                    events = await like_events(db, deltas)
+                if deltas:
+                    await bump("feed")
+                for event in events:
+                    await bus.publish(event)
+                return len(self.flushing)
+            except BaseException:
+                # keep the pairs for the next flush unless toggled again
+                # since; writing a state twice is harmless
+                self.pending = self.flushing | self.pending
+                raise
+            finally:
+                self.flushing = {}
+
+    @asynccontextmanager
+    async def taking(self, pairs: Iterable[Pair]) -> AsyncIterator[Dict]:
+        """Take the pending state of pairs, once no flush is running, for
+        the caller to write before its own writes to them; the state is put
+        back if the block fails"""
+        async with self._writing:
+            taken = {
+                pair: self.pending.pop(pair)
+                for pair in set(pairs)
+                if pair in self.pending
+            }
+            try:
+                yield taken
+            except BaseException:
+                self.pending = taken | self.pending
+                raise
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Like buffer flush failed")
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stop the background task and flush what is left"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+async def write_likes(
+    db: AsyncSession, changes: Dict[Pair, bool]
+) -> Dict[int, int]:
+    """Apply net like changes with one statement per kind of change, keep
+    tweets.like_count in step and return the change of every counter"""
+    deltas: Counter = Counter()
+    liked = [pair for pair, state in changes.items() if state]
+    unliked = [pair for pair, state in changes.items() if not state]
+    if liked:
+        pairs = values(
+            column("user_id", Integer),
+            column("tweet_id", Integer),
+            name="pairs",
+        ).data(liked)
+        # tweets deleted since the click are skipped by the join
+        known = select(pairs.c.user_id, Tweet.id).join(
+            Tweet,
+            (Tweet.id == pairs.c.tweet_id) & Tweet.deleted_at.is_(None),
+        )
+        deltas.update(
+            await db.scalars(
+                insert(likes_table)
+                .from_select(["user_id", "tweet_id"], known)
+                .on_conflict_do_nothing()
+                .returning(likes_table.c.tweet_id)
+            )
+        )
+    if unliked:
+        deltas.subtract(
+            await db.scalars(
+                delete(likes_table)
+                .where(
+                    tuple_(likes_table.c.user_id, likes_table.c.tweet_id).in_(
+                        unliked
+                    )
+                )
+                .returning(likes_table.c.tweet_id)
+            )
+        )
+    changed = {tweet_id: delta for tweet_id, delta in deltas.items() if delta}
+    if changed:
+        counts = values(
+            column("id", Integer), column("delta", Integer), name="deltas"
+        ).data(list(changed.items()))
+        await db.execute(
+            update(Tweet)
+            .where(Tweet.id == counts.c.id)
+            .values(like_count=Tweet.like_count + counts.c.delta)
+        )
+    return changed
+
+
+async def merge_pending_likes(
+    db: AsyncSession, likes: Dict[int, List[Dict]], tweet_ids: List[int]
+) -> None:
+    """Apply buffered toggles to the likes loaded for tweet_ids"""
+    changes = like_buffer.state(tweet_ids)
+    if not changes:
+        return
+    added = {user_id for (user_id, _), liked in changes.items() if liked}
+    names: Dict[int, str] = {}
+    if added:
+        query = select(User.id, User.name).where(User.id.in_(added))
+        names = {user_id: name for user_id, name in await db.execute(query)}
+    for (user_id, tweet_id), liked in changes.items():
+        users = likes[tweet_id]
+        present = any(like["user_id"] == user_id for like in users)
+        if liked and not present and user_id in names:
+            users.append({"user_id": user_id, "name": names[user_id]})
+        elif not liked and present:
+            likes[tweet_id] = [
+                like for like in users if like["user_id"] != user_id
+            ]
+
+
+like_buffer = LikeBuffer()
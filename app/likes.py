@@ -0,0 +1,80 @@
+"""Denormalized like counters.
+
+tweets.like_count is changed in the same transaction as the likes_table
+row it counts. Drift (manual edits, failed deploys, bulk imports) is
+repaired with:
+
+    python -m app.likes reconcile
+"""
+
+import argparse
+import asyncio
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import Session as DBSession
+from app.database import engine
+from app.models import Tweet, likes_table
+
+RECONCILE_BATCH_SIZE = 10000
+
+
+def change_like_count(tweet_id: int, delta: int):
+    """UPDATE statement that shifts the counter of a tweet by delta"""
+    return (
+        update(Tweet)
+        .where(Tweet.id == tweet_id)
+        .values(like_count=Tweet.like_count + delta)
+    )
+
+
+async def reconcile_like_counts(
+    db: AsyncSession, batch_size: int = RECONCILE_BATCH_SIZE
+) -> int:
+    """Recount likes of every tweet in id ranges of batch_size, committing
+    after each range, and return the number of repaired tweets"""
+    actual = (
+        select(func.count())
+        .where(likes_table.c.tweet_id == Tweet.id)
+        .scalar_subquery()
+    )
+    last_id = await db.scalar(select(func.max(Tweet.id))) or 0
+    repaired = 0
+    for start in range(0, last_id, batch_size):
+        result = await db.execute(
+            update(Tweet)
+            .where(
+                Tweet.id > start,
+                Tweet.id <= start + batch_size,
+                Tweet.like_count != actual,
+            )
+            .values(like_count=actual)
+        )
+        await db.commit()
+        repaired += result.rowcount
+    return repaired
+
+
+async def reconcile(batch_size: int) -> None:
+    async with DBSession() as db:
+        repaired = await reconcile_like_counts(db, batch_size)
+    await engine.dispose()
+    print(f"{repaired} like counters repaired")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.likes")
+    commands = parser.add_subparsers(dest="command", required=True)
+    reconcile_parser = commands.add_parser(
+        "reconcile", help="recount like counters from the likes table"
+    )
+    reconcile_parser.add_argument(
+        "--batch-size", type=int, default=RECONCILE_BATCH_SIZE
+    )
+    args = parser.parse_args()
+    asyncio.run(reconcile(args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Batch loaders for tweet payloads.
+
+Each loader fetches one kind of related data for a whole page of tweets in
+a single query and returns it keyed by tweet id, so building a page costs
+the same number of queries whatever its size. Rows are read as plain
+tuples; no ORM instances are created.
+"""
+
+from collections import defaultdict
+from typing import Dict, List
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.like_buffer import merge_pending_likes
+from app.models import Media, MediaVariant, Tweet, User, likes_table
+
+
+async def load_tweet_rows(db: AsyncSession, tweet_ids: List[int]) -> Dict:
+    """Content and author of every tweet"""
+    query = (
+        select(Tweet.id, Tweet.content, User.id, User.name)
+        .join(User, User.id == Tweet.author_id)
+        .where(Tweet.id.in_(tweet_ids), Tweet.deleted_at.is_(None))
+    )
+    return {
+        tweet_id: {
+            "id": tweet_id,
+            "content": content,
+            "author": {"id": author_id, "name": author_name},
+        }
+        for tweet_id, content, author_id, author_name in await db.execute(query)
+    }
+
+
+async def load_attachments(db: AsyncSession, tweet_ids: List[int]) -> Dict:
+    """Links of the attachments of every tweet, with their variants"""
+    query = (
+        select(
+            Media.tweet_id,
+            Media.id,
+            Media.link,
+            MediaVariant.name,
+            MediaVariant.format,
+            MediaVariant.link,
+        )
+        .outerjoin(MediaVariant, MediaVariant.media_id == Media.id)
+        .where(Media.tweet_id.in_(tweet_ids))
+        .order_by(Media.id)
+    )
+    attachments: Dict[int, Dict] = defaultdict(dict)
+    for tweet_id, media_id, link, name, fmt, variant_link in await db.execute(
+        query
+    ):
+        media = attachments[tweet_id].setdefault(
+            media_id, {"link": link, "variants": {}}
+        )
+        if name is not None:
+            media["variants"].setdefault(name, {})[fmt] = variant_link
+    return attachments
+
+
+async def load_likes(db: AsyncSession, tweet_ids: List[int]) -> Dict:
+    """Users who liked every tweet"""
+    query = (
+        select(likes_table.c.tweet_id, User.id, User.name)
+        .join(User, User.id == likes_table.c.user_id)
+        .where(likes_table.c.tweet_id.in_(tweet_ids))
+    )
+    likes: Dict[int, List] = defaultdict(list)
+    for tweet_id, user_id, name in await db.execute(query):
+        likes[tweet_id].append({"user_id": user_id, "name": name})
+    return likes
+
+
+async def load_tweets(db: AsyncSession, tweet_ids: List[int]) -> List[Dict]:
+    """Build feed payloads in three queries, keeping the order of
+    tweet_ids; likes still in the write-behind buffer are merged in"""
+    if not tweet_ids:
+        return []
+    tweets = await load_tweet_rows(db, tweet_ids)
+    attachments = await load_attachments(db, tweet_ids)
+    likes = await load_likes(db, tweet_ids)
+    await merge_pending_likes(db, likes, tweet_ids)
+
+    page = []
+    for tweet_id in tweet_ids:
+        if tweet_id not in tweets:
+            continue
+        media = attachments[tweet_id].values()
+        page.append(
+            {
+                "id": tweet_id,
+                "content": tweets[tweet_id]["content"],
+                "attachments": [ta["link"] for ta in media],
+                "attachment_variants": [ta["variants"] for ta in media],
+                "author": tweets[tweet_id]["author"],
+                "likes": likes[tweet_id],
+            }
+        )
+    return page
@@ -1,25 +1,65 @@
+import logging
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 
-from app.database import Base, engine, get_db
+from app.cleanup import CLEANUP_ENABLED, cleaner
+from app.database import Session, engine, replica_engines
+from app.events import EVENTS_NOTIFY_ENABLED, bus
+from app.like_buffer import LIKE_BUFFER_ENABLED, like_buffer
+from app.metrics import (
+    METRICS_ENABLED,
+    TimedORJSONResponse,
+    TimingMiddleware,
+    instrument,
+    metrics,
+)
+from app.media import MEDIA_MAX_SIZE, UploadSizeLimitMiddleware
 from app.routes import create_routes
 from app.security import create_first_user_for_login
+from app.thumbnails import shutdown_executor
+from app.trending import TRENDING_ENABLED, trending
 
-session_ = get_db()
+logger = logging.getLogger(__name__)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    Base.metadata.create_all(engine)
-    create_first_user_for_login(next(session_))
+    async with Session() as db:
+        await create_first_user_for_login(db)
+    if EVENTS_NOTIFY_ENABLED:
+        await bus.start()
+    if LIKE_BUFFER_ENABLED:
+        like_buffer.start()
+    if CLEANUP_ENABLED:
+        cleaner.start()
+    if TRENDING_ENABLED:
+        trending.start()
     yield
-    engine.dispose()
+    # a failed step, e.g. the final flush of likes, must not keep the others
+    # from running
+    for stop in (trending.stop, cleaner.stop, like_buffer.stop, bus.stop):
+        try:
+            await stop()
+        except Exception:
+            logger.exception("Shutdown step failed")
+    shutdown_executor()
+    await engine.dispose()
+    for replica in replica_engines:
+        await replica.dispose()
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=TimedORJSONResponse)
+app.add_middleware(
+    UploadSizeLimitMiddleware, path="/api/medias", max_size=MEDIA_MAX_SIZE
+)
+if METRICS_ENABLED:
+    app.add_middleware(TimingMiddleware)
+    app.add_route("/metrics", metrics, include_in_schema=False)
+    for instrumented in (engine, *replica_engines):
+        instrument(instrumented)
 
 
 @app.exception_handler(HTTPException)
@@ -31,6 +71,7 @@ async def http_exception_handler(request: Request, exc) -> JSONResponse:
             "error_message": exc.detail,
         },
         status_code=exc.status_code,
+        headers=exc.headers,
     )
 
 
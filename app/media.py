@@ -0,0 +1,122 @@
+"""Content-addressed storage for uploaded media.
+
+Uploads are streamed to a temporary file in chunks while being hashed, and
+renamed to medias/<sha256[:2]>/<sha256><ext> once complete, so identical
+files are stored once no matter how many times they are uploaded. All
+disk I/O runs in the thread pool to keep the event loop free.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+
+from fastapi import HTTPException, UploadFile
+from starlette import status
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+MEDIA_DIR = os.environ.get("MEDIA_DIR", "./medias/")
+MEDIA_MAX_SIZE = int(os.environ.get("MEDIA_MAX_SIZE", 10 * 1024 * 1024))
+MEDIA_CHUNK_SIZE = 256 * 1024
+# room for multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+FILE_TOO_LARGE = HTTPException(
+    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    detail="File too large",
+)
+
+
+class UploadSizeLimitMiddleware:
+    """Reject request bodies above max_size on the upload path before they
+    are spooled: up front from Content-Length, and otherwise as soon as the
+    received bytes cross the limit"""
+
+    def __init__(self, app: ASGIApp, path: str, max_size: int):
+        self.app = app
+        self.path = path
+        self.max_body_size = max_size + MULTIPART_OVERHEAD
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        too_large = (
+            content_length.isdigit()
+            and int(content_length) > self.max_body_size
+        )
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            if too_large:
+                raise FILE_TOO_LARGE
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.max_body_size:
+                raise FILE_TOO_LARGE
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def media_path(link: str) -> Path:
+    """Location on disk of a link returned by store_upload"""
+    return Path(MEDIA_DIR) / Path(link).relative_to("medias")
+
+
+def _safe_suffix(filename: str) -> str:
+    suffix = Path(filename).suffix.lower()
+    return suffix if re.fullmatch(r"\.[a-z0-9]{1,10}", suffix) else ""
+
+
+def _open_temporary(media_dir: Path):
+    media_dir.mkdir(parents=True, exist_ok=True)
+    return tempfile.NamedTemporaryFile(
+        dir=media_dir, prefix=".upload-", delete=False
+    )
+
+
+def _discard(path: str) -> None:
+    Path(path).unlink(missing_ok=True)
+
+
+def _commit_blob(temporary_path: str, blob_path: Path) -> None:
+    if blob_path.exists():
+        _discard(temporary_path)
+        # tells app.cleanup the blob is about to be linked again
+        os.utime(blob_path)
+        return
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(temporary_path, blob_path)
+
+
+async def store_upload(file: UploadFile, max_size: int = MEDIA_MAX_SIZE):
+    """Stream an upload into content-addressed storage and return the link
+    to it, relative to the site root"""
+    media_dir = Path(MEDIA_DIR)
+    temporary = await run_in_threadpool(_open_temporary, media_dir)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        while chunk := await file.read(MEDIA_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_size:
+                raise FILE_TOO_LARGE
+            digest.update(chunk)
+            await run_in_threadpool(temporary.write, chunk)
+        await run_in_threadpool(temporary.close)
+
+        name = digest.hexdigest() + _safe_suffix(file.filename or "")
+        await run_in_threadpool(
+            _commit_blob, temporary.name, media_dir / name[:2] / name
+        )
+    except BaseException:
+        await run_in_threadpool(temporary.close)
+        await run_in_threadpool(_discard, temporary.name)
+        raise
+    return f"medias/{name[:2]}/{name}"
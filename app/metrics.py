@@ -0,0 +1,220 @@
+"""Opt-in request timing.
+
+With METRICS_ENABLED=1 every request is timed by TimingMiddleware:
+
+- wall time of the whole request;
+- number of SQL statements and time spent in them, from cursor events on
+  the engine;
+- time spent encoding the response body by TimedORJSONResponse.
+
+The figures of a request are sent back in a Server-Timing header, added to
+per-route totals served in the Prometheus text format at /metrics, and
+requests slower than SLOW_REQUEST_MS are logged with their statements.
+Totals are kept per worker process.
+"""
+
+import logging
+import os
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED") == "1"
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 500))
+# statements included in a slow-request log line
+SLOW_REQUEST_STATEMENTS = 20
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RequestTiming:
+    start: float = field(default_factory=time.perf_counter)
+    statements: List[Tuple[str, float]] = field(default_factory=list)
+    db_time: float = 0.0
+    serialization_time: float = 0.0
+
+    def server_timing(self, wall_time: float) -> str:
+        return (
+            f"app;dur={wall_time * 1000:.1f}, "
+            f'db;dur={self.db_time * 1000:.1f};desc="'
+            f'{len(self.statements)} statements", '
+            f"serialize;dur={self.serialization_time * 1000:.1f}"
+        )
+
+
+current_timing: ContextVar[Optional[RequestTiming]] = ContextVar(
+    "current_timing", default=None
+)
+
+
+@dataclass
+class RouteTotals:
+    requests: int = 0
+    wall_time: float = 0.0
+    db_time: float = 0.0
+    statements: int = 0
+    serialization_time: float = 0.0
+    buckets: List[int] = field(
+        default_factory=lambda: [0] * len(LATENCY_BUCKETS)
+    )
+
+
+# (method, route path, status) -> totals
+route_totals: Dict[Tuple[str, str, int], RouteTotals] = defaultdict(RouteTotals)
+
+
+def _before_cursor_execute(conn, cursor, statement, *args):
+    if current_timing.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, *args):
+    timing = current_timing.get()
+    if timing is not None and conn.info.get("query_start"):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        timing.statements.append((statement, elapsed))
+        timing.db_time += elapsed
+
+
+def instrument(engine: AsyncEngine) -> None:
+    """Time the statements of engine for the request being served"""
+    sync_engine = engine.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def uninstrument(engine: AsyncEngine) -> None:
+    sync_engine = engine.sync_engine
+    event.remove(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.remove(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class TimedORJSONResponse(ORJSONResponse):
+    """ORJSONResponse that reports its encoding time to the request
+    timing"""
+
+    def render(self, content: Any) -> bytes:
+        start = time.perf_counter()
+        body = super().render(content)
+        timing = current_timing.get()
+        if timing is not None:
+            timing.serialization_time += time.perf_counter() - start
+        return body
+
+
+def record(
+    method: str, path: str, status: int, timing: RequestTiming, wall: float
+) -> None:
+    totals = route_totals[(method, path, status)]
+    totals.requests += 1
+    totals.wall_time += wall
+    totals.db_time += timing.db_time
+    totals.statements += len(timing.statements)
+    totals.serialization_time += timing.serialization_time
+    for number, bound in enumerate(LATENCY_BUCKETS):
+        if wall <= bound:
+            totals.buckets[number] += 1
+
+    if wall * 1000 >= SLOW_REQUEST_MS:
+        statements = "\n".join(
+            f"  {elapsed * 1000:.1f} ms: {statement}"
+            for statement, elapsed in timing.statements[
+                :SLOW_REQUEST_STATEMENTS
+            ]
+        )
+        logger.warning(
+            "Slow request %s %s: %.1f ms, %d statements in %.1f ms\n%s",
+            method,
+            path,
+            wall * 1000,
+            len(timing.statements),
+            timing.db_time * 1000,
+            statements,
+        )
+
+
+class TimingMiddleware:
+    """Time every http request and add a Server-Timing header"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = current_timing.set(timing)
+        status = 500
+
+        async def timed_send(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                wall = time.perf_counter() - timing.start
+                headers = list(message.get("headers", []))
+                headers.append(
+                    (b"server-timing", timing.server_timing(wall).encode())
+                )
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            current_timing.reset(token)
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            wall = time.perf_counter() - timing.start
+            record(scope["method"], path, status, timing, wall)
+
+
+def render_metrics() -> str:
+    """Route totals in the Prometheus text exposition format"""
+    rows = [
+        (f'method="{method}",route="{path}",status="{status}"', totals)
+        for (method, path, status), totals in sorted(route_totals.items())
+    ]
+    lines = ["# TYPE http_request_duration_seconds histogram"]
+    for labels, totals in rows:
+        for bound, count in zip(LATENCY_BUCKETS, totals.buckets):
+            lines.append(
+                "http_request_duration_seconds_bucket"
+                f'{{{labels},le="{bound}"}} {count}'
+            )
+        lines += [
+            "http_request_duration_seconds_bucket"
+            f'{{{labels},le="+Inf"}} {totals.requests}',
+            f"http_request_duration_seconds_sum{{{labels}}} "
+            f"{totals.wall_time}",
+            f"http_request_duration_seconds_count{{{labels}}} "
+            f"{totals.requests}",
+        ]
+    counters = {
+        "http_request_db_seconds_total": "db_time",
+        "http_request_db_statements_total": "statements",
+        "http_request_serialization_seconds_total": "serialization_time",
+    }
+    for name, attribute in counters.items():
+        lines.append(f"# TYPE {name} counter")
+        lines += [
+            f"{name}{{{labels}}} {getattr(totals, attribute)}"
+            for labels, totals in rows
+        ]
+    return "\n".join(lines) + "\n"
+
+
+async def metrics(request) -> PlainTextResponse:
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4"
+    )
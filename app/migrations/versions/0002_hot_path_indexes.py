@@ -0,0 +1,50 @@
+"""hot path indexes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 04:50:03.118402
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = (
+    ("ix_keys_key", "keys", ["key"], True),
+    ("ix_likes_tweet_id", "likes", ["tweet_id"], False),
+    ("ix_user_following_follower_id", "user_following", ["follower_id"], False),
+    ("ix_tweets_author_id_id", "tweets", ["author_id", "id"], False),
+    ("ix_medias_tweet_id", "medias", ["tweet_id"], False),
+)
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    with op.get_context().autocommit_block():
+        for name, table, columns, unique in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                unique=unique,
+                if_not_exists=True,
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(
+                name,
+                table_name=table,
+                if_exists=True,
+                postgresql_concurrently=True,
+            )
@@ -0,0 +1,56 @@
+"""tweet like count
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 05:02:41.530217
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tweets",
+        sa.Column(
+            "like_count", sa.Integer(), server_default="0", nullable=False
+        ),
+    )
+    op.execute(
+        """
+        UPDATE tweets SET like_count = counts.like_count
+        FROM (
+            SELECT tweet_id, count(*) AS like_count
+            FROM likes GROUP BY tweet_id
+        ) AS counts
+        WHERE tweets.id = counts.tweet_id
+        """
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_tweets_like_count_id",
+            "tweets",
+            ["like_count", "id"],
+            if_not_exists=True,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_tweets_like_count_id",
+            table_name="tweets",
+            if_exists=True,
+            postgresql_concurrently=True,
+        )
+    op.drop_column("tweets", "like_count")
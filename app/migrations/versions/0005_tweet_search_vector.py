@@ -0,0 +1,52 @@
+"""tweet search vector
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 07:12:25.804113
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # adding a stored generated column rewrites the tweets table
+    op.add_column(
+        "tweets",
+        sa.Column(
+            "search_vector",
+            postgresql.TSVECTOR(),
+            sa.Computed("to_tsvector('simple', content)", persisted=True),
+            nullable=True,
+        ),
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_tweets_search_vector",
+            "tweets",
+            ["search_vector"],
+            postgresql_using="gin",
+            if_not_exists=True,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_tweets_search_vector",
+            table_name="tweets",
+            if_exists=True,
+            postgresql_concurrently=True,
+        )
+    op.drop_column("tweets", "search_vector")
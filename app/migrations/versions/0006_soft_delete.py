@@ -0,0 +1,76 @@
+"""soft delete
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 13:40:11.527390
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0006"
+down_revision: Union[str, None] = "0005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = (
+    (
+        "ix_tweets_deleted_at",
+        "tweets",
+        ["deleted_at"],
+        "deleted_at IS NOT NULL",
+    ),
+    (
+        "ix_medias_orphan_created_at",
+        "medias",
+        ["created_at"],
+        "tweet_id IS NULL",
+    ),
+    ("ix_medias_link", "medias", ["link"], None),
+    ("ix_media_variants_link", "media_variants", ["link"], None),
+)
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tweets",
+        sa.Column("deleted_at", sa.DateTime(timezone=True), nullable=True),
+    )
+    # existing uploads count as uploaded now and get a full grace period;
+    # a non-volatile default does not rewrite the table
+    op.add_column(
+        "medias",
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+    )
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                if_not_exists=True,
+                postgresql_concurrently=True,
+                postgresql_where=sa.text(where) if where else None,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(
+                name,
+                table_name=table,
+                if_exists=True,
+                postgresql_concurrently=True,
+            )
+    op.drop_column("medias", "created_at")
+    op.drop_column("tweets", "deleted_at")
@@ -0,0 +1,51 @@
+"""like created at
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 15:02:47.318604
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0007"
+down_revision: Union[str, None] = "0006"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # existing likes count as given now; a non-volatile default does not
+    # rewrite the table
+    op.add_column(
+        "likes",
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_likes_created_at",
+            "likes",
+            ["created_at"],
+            if_not_exists=True,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_likes_created_at",
+            table_name="likes",
+            if_exists=True,
+            postgresql_concurrently=True,
+        )
+    op.drop_column("likes", "created_at")
@@ -0,0 +1,32 @@
+"""media uploader
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 18:21:09.402117
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0008"
+down_revision: Union[str, None] = "0007"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # existing uploads keep no uploader; the unattached ones can no longer
+    # be attached and are swept as orphans
+    op.add_column("medias", sa.Column("user_id", sa.Integer(), nullable=True))
+    op.create_foreign_key(
+        "medias_user_id_fkey", "medias", "users", ["user_id"], ["id"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint("medias_user_id_fkey", "medias", type_="foreignkey")
+    op.drop_column("medias", "user_id")
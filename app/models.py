@@ -1,6 +1,18 @@
-from typing import List
-
-from sqlalchemy import Column, ForeignKey, Integer, Table, UniqueConstraint
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import (
+    Column,
+    Computed,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    Table,
+    UniqueConstraint,
+    func,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.database import Base
@@ -15,7 +27,16 @@ likes_table = Table(
         primary_key=True,
     ),
     Column("tweet_id", Integer, ForeignKey("tweets.id"), primary_key=True),
+    # read incrementally by app.trending
+    Column(
+        "created_at",
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+    ),
     UniqueConstraint("user_id", "tweet_id", name="unique_likes"),
+    Index("ix_likes_tweet_id", "tweet_id"),
+    Index("ix_likes_created_at", "created_at"),
 )
 
 user_following = Table(
@@ -23,6 +44,7 @@ user_following = Table(
     Base.metadata,
     Column("user_id", Integer, ForeignKey("users.id"), primary_key=True),
     Column("follower_id", Integer, ForeignKey("users.id"), primary_key=True),
+    Index("ix_user_following_follower_id", "follower_id"),
 )
 
 
@@ -59,9 +81,53 @@ class Media(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     link: Mapped[str] = mapped_column(nullable=False)
     tweet_id: Mapped[int] = mapped_column(
-        ForeignKey("tweets.id"), nullable=True
+        ForeignKey("tweets.id"), nullable=True, index=True
+    )
+    # the uploader, who alone may attach it; None for uploads made before
+    # it was recorded
+    user_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey("users.id"), nullable=True
+    )
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
     )
     tweet = relationship("Tweet", back_populates="attachments")
+    variants: Mapped[List["MediaVariant"]] = relationship(
+        back_populates="media",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+    __table_args__ = (
+        Index("ix_medias_link", "link"),
+        # uploads never attached to a tweet, for the orphan sweeper
+        Index(
+            "ix_medias_orphan_created_at",
+            "created_at",
+            postgresql_where=tweet_id.is_(None),
+        ),
+    )
+
+
+class MediaVariant(Base):
+    __tablename__ = "media_variants"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    media_id: Mapped[int] = mapped_column(
+        ForeignKey("medias.id", ondelete="CASCADE"), nullable=False
+    )
+    name: Mapped[str] = mapped_column(nullable=False)
+    format: Mapped[str] = mapped_column(nullable=False)
+    link: Mapped[str] = mapped_column(nullable=False)
+    width: Mapped[int] = mapped_column(nullable=False)
+    height: Mapped[int] = mapped_column(nullable=False)
+    media = relationship("Media", back_populates="variants")
+
+    __table_args__ = (
+        UniqueConstraint(
+            "media_id", "name", "format", name="unique_media_variants"
+        ),
+        Index("ix_media_variants_link", "link"),
+    )
 
 
 class Tweet(Base):
@@ -71,6 +137,19 @@ class Tweet(Base):
     author_id: Mapped[int] = mapped_column(
         ForeignKey("users.id"), nullable=False
     )
+    like_count: Mapped[int] = mapped_column(
+        nullable=False, default=0, server_default="0"
+    )
+    # set by delete_tweet_by_id; the rows are removed later by app.cleanup
+    deleted_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+    # maintained by Postgres on every insert or update of content
+    search_vector = mapped_column(
+        TSVECTOR,
+        Computed("to_tsvector('simple', content)", persisted=True),
+        deferred=True,
+    )
 
     attachments: Mapped[List[Media]] = relationship(
         "Media",
@@ -80,9 +159,40 @@ class Tweet(Base):
     likes: Mapped[List[User]] = relationship(secondary=likes_table)
     author = relationship("User", back_populates="tweets", lazy="joined")
 
+    __table_args__ = (
+        Index("ix_tweets_author_id_id", "author_id", "id"),
+        Index("ix_tweets_like_count_id", "like_count", "id"),
+        Index(
+            "ix_tweets_search_vector", "search_vector", postgresql_using="gin"
+        ),
+        Index(
+            "ix_tweets_deleted_at",
+            "deleted_at",
+            postgresql_where=deleted_at.is_not(None),
+        ),
+    )
+
 
 class Key(Base):
     __tablename__ = "keys"
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
-    key: Mapped[str] = mapped_column(nullable=False)
+    key: Mapped[str] = mapped_column(nullable=False, unique=True, index=True)
+
+
+class TimelineEntry(Base):
+    __tablename__ = "timelines"
+    user_id: Mapped[int] = mapped_column(
+        ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+    tweet_id: Mapped[int] = mapped_column(
+        ForeignKey("tweets.id", ondelete="CASCADE"), primary_key=True
+    )
+    author_id: Mapped[int] = mapped_column(
+        ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
+
+    __table_args__ = (
+        Index("ix_timelines_tweet_id", "tweet_id"),
+        Index("ix_timelines_user_id_author_id", "user_id", "author_id"),
+    )
@@ -0,0 +1,75 @@
+"""User profile payloads behind a cache.
+
+A profile is the user with their followers and the users they follow.
+Payloads are cached by user id in the backend selected by CACHE_URL and
+invalidated by follow_user/unfollow_user for both ends of the edge, which
+also changes the ETags of both profiles. Misses are loaded from the
+primary: a reader right after an invalidation must not cache what a
+lagging replica still returns.
+"""
+
+import os
+from typing import Dict, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from app.cache import CACHE_URL, create_backend
+from app.etags import bump
+from app.models import User, user_following
+
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", 300))
+
+profile_cache = create_backend(
+    CACHE_URL, ttl=PROFILE_CACHE_TTL, prefix="microblog:profiles:"
+)
+
+
+def profile_key(user_id: int) -> str:
+    return f"profile:{user_id}"
+
+
+async def load_profile(db: AsyncSession, user_id: int) -> Optional[Dict]:
+    """Read a profile with two separate loads instead of joining followers
+    and following into one followers x following result. Both come from
+    the database, not the per-worker follow cache, since the result is
+    cached for every worker."""
+    query = (
+        select(User)
+        .options(selectinload(User.followers))
+        .where(User.id == user_id)
+    )
+    user = await db.scalar(query)
+    if user is None:
+        return None
+    following = await db.execute(
+        select(User.id, User.name)
+        .join(user_following, user_following.c.user_id == User.id)
+        .where(user_following.c.follower_id == user_id)
+        .order_by(User.id)
+    )
+    return {
+        "id": user.id,
+        "name": user.name,
+        "followers": [{"id": u.id, "name": u.name} for u in user.followers],
+        "following": [{"id": id, "name": name} for id, name in following],
+    }
+
+
+async def get_profile(db: AsyncSession, user_id: int) -> Optional[Dict]:
+    """Cached profile of user_id; db must be on the primary, or a replica
+    lagging behind invalidate_profiles would put the old profile back
+    under the new ETag"""
+    profile = await profile_cache.get(profile_key(user_id))
+    if profile is None:
+        profile = await load_profile(db, user_id)
+        if profile is not None:
+            await profile_cache.set(profile_key(user_id), profile)
+    return profile
+
+
+async def invalidate_profiles(*user_ids: int) -> None:
+    """Must be called after the follow edges of user_ids are committed"""
+    await profile_cache.delete(*(profile_key(id) for id in user_ids))
+    await bump(*(f"profile:{id}" for id in user_ids))
@@ -0,0 +1,176 @@
+"""Per-user rate limiting and load shedding.
+
+Every API route depends on rate_limit(route_class) for its class:
+
+- "read": feed, search, profiles, the event stream;
+- "write": tweets, likes, follows;
+- "media": uploads.
+
+With RATE_LIMIT_ENABLED=1 each user has a token bucket per class. A bucket
+holds up to `burst` tokens and refills at `rate` tokens per second; every
+request takes one token, and a request finding the bucket empty gets a 429
+with Retry-After set to the seconds until a token is back. Limits are set
+per class as "<rate>:<burst>", e.g. RATE_LIMIT_READ=20:40.
+
+Buckets live in the worker by default, so with N workers a user gets up to
+N times the limits. With RATE_LIMIT_URL (defaulting to CACHE_URL) pointing
+to Redis they are shared by every worker and updated by a Lua script, so a
+take is atomic and a single round trip.
+
+Independently, while the database pool of this worker has made recent
+checkouts wait longer than LOAD_SHED_POOL_WAIT_MS on average, requests are
+answered 503 before they queue for a connection themselves, even to look
+up their api key. 0 disables shedding; PgBouncer mode has no pool to
+watch.
+"""
+
+import math
+import os
+import time
+from typing import Annotated, Dict, List, Optional, Tuple
+
+from fastapi import Depends, HTTPException
+from starlette import status
+
+from app.cache import CACHE_URL, LRUCache
+from app.database import pool_wait
+from app.security import check_authentication_key
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED") == "1"
+RATE_LIMIT_URL = os.environ.get("RATE_LIMIT_URL", CACHE_URL)
+# buckets kept by the in-process backend
+RATE_LIMIT_KEYS = int(os.environ.get("RATE_LIMIT_KEYS", 100000))
+LOAD_SHED_POOL_WAIT_MS = float(os.environ.get("LOAD_SHED_POOL_WAIT_MS", 250))
+
+
+def parse_limit(value: str) -> Tuple[float, float]:
+    rate, burst = value.split(":")
+    return float(rate), float(burst)
+
+
+# route class -> (tokens per second, bucket size)
+RATE_LIMITS: Dict[str, Tuple[float, float]] = {
+    "read": parse_limit(os.environ.get("RATE_LIMIT_READ", "20:40")),
+    "write": parse_limit(os.environ.get("RATE_LIMIT_WRITE", "5:20")),
+    "media": parse_limit(os.environ.get("RATE_LIMIT_MEDIA", "1:10")),
+}
+
+
+def refill(
+    tokens: float, updated: float, now: float, rate: float, burst: float
+) -> Tuple[float, float]:
+    """Take a token from a bucket last seen at updated with tokens in it;
+    return the tokens left and the seconds to wait, 0 when admitted"""
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBuckets:
+    """Token buckets local to the worker process"""
+
+    def __init__(self, maxsize: int = RATE_LIMIT_KEYS):
+        # an evicted or expired bucket was full anyway
+        self.buckets = LRUCache(maxsize=maxsize, ttl=0)
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        now = time.monotonic()
+        found, state = self.buckets.get(key)
+        tokens, updated = state if found else (burst, now)
+        tokens, wait = refill(tokens, updated, now, rate, burst)
+        self.buckets.set(key, (tokens, now), ttl=burst / rate)
+        return wait
+
+
+# KEYS[1]: bucket; ARGV: rate, burst. Returns the wait as a string, since
+# Lua numbers are truncated to integers on the way out.
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated',
+    tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    """Token buckets shared by every worker, kept in Redis hashes and
+    updated atomically with the server's clock"""
+
+    def __init__(self, client, prefix: str = "microblog:ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        wait = await self._take(keys=[self.prefix + key], args=[rate, burst])
+        return float(wait)
+
+
+def create_buckets(url: Optional[str]):
+    """Buckets for a RATE_LIMIT_URL: empty or local:// for the in-process
+    backend, redis://... for Redis"""
+    if not url or url.startswith("local://"):
+        return MemoryBuckets()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            from redis import asyncio as redis  # type: ignore[import-untyped]
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_URL needs the redis package")
+        return RedisBuckets(redis.from_url(url))
+    raise ValueError(f"Unsupported rate limit url {url!r}")
+
+
+buckets = create_buckets(RATE_LIMIT_URL)
+
+
+def _retry_after(seconds: float) -> Dict[str, str]:
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+
+async def shed_load() -> None:
+    """503 while the pool makes checkouts wait; depends on nothing, so it
+    runs before authentication can queue for a connection itself"""
+    if LOAD_SHED_POOL_WAIT_MS and pool_wait() * 1000 > LOAD_SHED_POOL_WAIT_MS:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server overloaded",
+            headers=_retry_after(1),
+        )
+
+
+def rate_limit(route_class: str) -> List:
+    """Dependencies of a route of route_class, for its decorator"""
+
+    async def limit(
+        auth: Annotated[dict, Depends(check_authentication_key)],
+    ) -> None:
+        if not RATE_LIMIT_ENABLED:
+            return
+        rate, burst = RATE_LIMITS[route_class]
+        wait = await buckets.take(
+            f"{route_class}:{auth['user_id']}", rate, burst
+        )
+        if wait:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests",
+                headers=_retry_after(wait),
+            )
+
+    # FastAPI solves route dependencies in this order
+    return [Depends(shed_load), Depends(limit)]
@@ -1,109 +1,213 @@
-import os
-import shutil
-from datetime import datetime
-from pathlib import Path
-from typing import Annotated, Dict
+import logging
+from collections import Counter
+from typing import Annotated, Awaitable, Optional
 
-from fastapi import Depends, HTTPException, UploadFile
-from fastapi.encoders import jsonable_encoder
-from sqlalchemy import delete, insert, select, update
-from sqlalchemy.orm import Session, joinedload
+from fastapi import (
+    BackgroundTasks,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+)
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, func, insert, literal, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
-from app.database import get_db
+from app.batch import add_follows, add_likes, add_tweets, invalidate_follows
+from app.database import get_db, get_primary_db, get_read_db
+from app.etags import bump, bumped_recently, make_etag, not_modified
+from app.events import bus, event_stream, like_event, like_events
+from app.feed import FEED_PAGE_SIZE, get_feed_page
+from app.follow_graph import get_following, invalidate_following
+from app.like_buffer import LIKE_BUFFER_ENABLED, like_buffer, write_likes
+from app.likes import change_like_count
+from app.loaders import load_tweets
+from app.media import store_upload
+from app.metrics import TimedORJSONResponse
 from app.models import Media, Tweet, User, likes_table, user_following
-from app.schemas import TweetIn
+from app.profiles import get_profile, invalidate_profiles
+from app.ratelimit import rate_limit
+from app.schemas import (
+    FeedOut,
+    FollowsBatchIn,
+    LikesBatchIn,
+    ProfileResponse,
+    TweetIn,
+    TweetsBatchIn,
+)
+from app.search import search_tweets
 from app.security import check_authentication_key
+from app.thumbnails import create_variants
+from app.timeline import (
+    TIMELINE_ENABLED,
+    follow_author,
+    get_timeline_page,
+    unfollow_author,
+)
+from app.trending import trending
 
 RESULT_TRUE = {"result": True}
-MEDIA_DIR = "./medias/"
+READ = rate_limit("read")
+WRITE = rate_limit("write")
+MEDIA = rate_limit("media")
+
+# Read routes declare their response model for the OpenAPI schema but return
+# an ORJSONResponse of the payloads built by the loaders, so FastAPI neither
+# validates nor re-encodes them on the way out.
+
+
+logger = logging.getLogger(__name__)
+
+
+async def after_commit(*effects: Awaitable) -> None:
+    """Run the side effects of a committed write, such as ETag bumps and
+    events. A failure is logged rather than reported: the write is stored,
+    and a client told otherwise would retry it."""
+    for effect in effects:
+        try:
+            await effect
+        except Exception:
+            logger.exception("Side effect of a committed write failed")
+
+
+def etag_headers(etag: Optional[str]) -> dict:
+    """Headers of a response with etag; etag is None, and there are no
+    headers, when ETags are disabled (see app.etags.make_etag)"""
+    if etag is None:
+        return {}
+    # the browser keeps the response but asks before every reuse
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def not_modified_response(etag: Optional[str]) -> Response:
+    """304 for a request whose If-None-Match matched etag; not_modified
+    never matches a None etag, so it is only None if the caller skipped
+    that check"""
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED, headers=etag_headers(etag)
+    )
 
 
 def create_routes(app):
-    @app.post("/api/auth")
-    def result(
+    @app.post("/api/auth", dependencies=READ)
+    async def result(
         auth: Annotated[dict, Depends(check_authentication_key)],
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
     ):
         """Getting authentication result"""
-        query = select(User).where(User.id == auth.get("user_id"))
-        user = db.scalar(query)
+        query = select(User).where(User.id == auth["user_id"])
+        user = await db.scalar(query)
         return user
 
-    @app.post("/api/tweets")
+    @app.post("/api/tweets", dependencies=WRITE)
     async def add_new_tweet(
         auth: Annotated[dict, Depends(check_authentication_key)],
         tweet: TweetIn,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
     ):
         """Add a new tweet"""
-        user_id = auth.get("user_id")
+        user_id = auth["user_id"]
         try:
-            query = (
-                insert(Tweet)
-                .values(content=tweet.tweet_data, author_id=user_id)
-                .returning(Tweet.id)
+            (id,) = await add_tweets(
+                db, user_id, [tweet], fan_out=TIMELINE_ENABLED
+            )
+            await db.commit()
+            await after_commit(
+                bump("feed"),
+                bus.publish(
+                    {"type": "tweet", "tweet_id": id, "author_id": user_id}
+                ),
+            )
+            return {"tweet_id": id} | RESULT_TRUE
+        except Exception:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect data"
             )
-            tweet_id = db.execute(query).fetchone()
-            db.commit()
 
-            if tweet_id:
-                id = tweet_id[0]
-                update_query = (
-                    update(Media)
-                    .where(Media.id.in_(tweet.tweet_media_ids))
-                    .values(tweet_id=id)
-                )
-                db.execute(update_query)
-                db.commit()
-                return {"tweet_id": id} | RESULT_TRUE
+    @app.post("/api/tweets:batch", dependencies=WRITE)
+    async def add_new_tweets(
+        auth: Annotated[dict, Depends(check_authentication_key)],
+        batch: TweetsBatchIn,
+        db: AsyncSession = Depends(get_db),
+    ):
+        """Add several tweets in one transaction"""
+        user_id = auth["user_id"]
+        try:
+            tweet_ids = await add_tweets(
+                db, user_id, batch.tweets, fan_out=TIMELINE_ENABLED
+            )
+            await db.commit()
+            await after_commit(
+                bump("feed"),
+                *(
+                    bus.publish(
+                        {"type": "tweet", "tweet_id": id, "author_id": user_id}
+                    )
+                    for id in tweet_ids
+                ),
+            )
+            items = [{"id": id, "status": "created"} for id in tweet_ids]
+            return {"items": items} | RESULT_TRUE
         except Exception:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect data"
             )
 
-    @app.post("/api/medias")
+    @app.post("/api/medias", dependencies=MEDIA)
     async def add_media_files(
         auth: Annotated[dict, Depends(check_authentication_key)],
         file: UploadFile,
-        db: Session = Depends(get_db),
+        background_tasks: BackgroundTasks,
+        db: AsyncSession = Depends(get_db),
     ):
         """Upload files from tweet"""
-        filename = f"{int(datetime.timestamp(datetime.now()))}-{file.filename}"
-        filename_path = Path(os.path.join(MEDIA_DIR, filename))
-
-        with filename_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        link = await store_upload(file)
         try:
             query = (
                 insert(Media)
-                .values(link=f"medias/{filename}")
+                .values(link=link, user_id=auth["user_id"])
                 .returning(Media.id)
             )
-            media_id = db.execute(query).fetchone()
-            db.commit()
+            media_id = (await db.execute(query)).fetchone()
+            await db.commit()
             if media_id:
                 id = media_id[0]
+                if (file.content_type or "").startswith("image/"):
+                    background_tasks.add_task(
+                        create_variants, id, link, db.bind
+                    )
                 return {"media_id": id} | RESULT_TRUE
         except Exception:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect data"
             )
 
-    @app.delete("/api/tweets/{tweet_id}")
+    @app.delete("/api/tweets/{tweet_id}", dependencies=WRITE)
     async def delete_tweet_by_id(
         auth: Annotated[dict, Depends(check_authentication_key)],
         tweet_id: int,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
     ):
         """Delete tweet by id"""
-        user_id = auth.get("user_id")
+        user_id = auth["user_id"]
         try:
-            query = select(Tweet).where(Tweet.id == tweet_id)
-            tweet = db.scalars(query).one()
-            if tweet.author_id == user_id:
-                db.delete(tweet)
-                db.commit()
+            # only marked here; likes, media and files go in app.cleanup
+            query = (
+                update(Tweet)
+                .where(
+                    Tweet.id == tweet_id,
+                    Tweet.author_id == user_id,
+                    Tweet.deleted_at.is_(None),
+                )
+                .values(deleted_at=func.now())
+                .returning(Tweet.id)
+            )
+            if (await db.execute(query)).fetchone():
+                await db.commit()
+                await after_commit(bump("feed"))
                 return RESULT_TRUE
             else:
                 raise Exception
@@ -112,40 +216,86 @@ def create_routes(app):
                 status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect data"
             )
 
-    @app.post("/api/tweets/{tweet_id}/likes")
+    @app.post("/api/tweets/{tweet_id}/likes", dependencies=WRITE)
     async def add_like(
         auth: Annotated[dict, Depends(check_authentication_key)],
         tweet_id: int,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
     ):
         """Add like to tweet"""
-        user_id = auth.get("user_id")
+        user_id = auth["user_id"]
+        if LIKE_BUFFER_ENABLED:
+            like_buffer.like(user_id, tweet_id)
+            await after_commit(bump("feed"))
+            return RESULT_TRUE
         try:
+            tweet = select(literal(user_id), Tweet.id).where(
+                Tweet.id == tweet_id, Tweet.deleted_at.is_(None)
+            )
             query = (
                 insert(likes_table)
-                .values(user_id=user_id, tweet_id=tweet_id)
+                .from_select(["user_id", "tweet_id"], tweet)
                 .returning(likes_table.c.tweet_id)
             )
-            result = db.execute(query).fetchone()
-            db.commit()
-            if result:
-                return RESULT_TRUE
-            # else:
-            #     db._transaction.rollback()
+            # no row for a missing or deleted tweet
+            if (await db.execute(query)).fetchone() is None:
+                raise Exception
+            author_id = await db.scalar(
+                change_like_count(tweet_id, 1).returning(Tweet.author_id)
+            )
+            await db.commit()
+            await after_commit(
+                bump("feed"), bus.publish(like_event(tweet_id, author_id, 1))
+            )
+            return RESULT_TRUE
         except Exception:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Incorrect data",
             )
 
-    @app.delete("/api/tweets/{tweet_id}/likes")
+    @app.post("/api/likes:batch", dependencies=WRITE)
+    async def add_likes_batch(
+        auth: Annotated[dict, Depends(check_authentication_key)],
+        batch: LikesBatchIn,
+        db: AsyncSession = Depends(get_db),
+    ):
+        """Like several tweets in one transaction"""
+        user_id = auth["user_id"]
+        pairs = [(user_id, tweet_id) for tweet_id in batch.tweet_ids]
+        try:
+            async with like_buffer.taking(pairs) as pending:
+                # toggles buffered before the batch are written first
+                deltas = Counter(await write_likes(db, pending))
+                items = await add_likes(db, user_id, batch.tweet_ids)
+                deltas.update(
+                    item["id"] for item in items if item["status"] == "created"
+                )
+                changed = {id: delta for id, delta in deltas.items() if delta}
+                events = await like_events(db, changed)
+                await db.commit()
+            if changed:
+                await after_commit(
+                    bump("feed"), *(bus.publish(event) for event in events)
+                )
+            return {"items": items} | RESULT_TRUE
+        except Exception:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect data"
+            )
+
+    @app.delete("/api/tweets/{tweet_id}/likes", dependencies=WRITE)
     async def delete_like(
         auth: Annotated[dict, Depends(check_authentication_key)],
         tweet_id: int,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
     ):
         """Delete like to tweet"""
-        user_id = auth.get("user_id")
+        user_id = auth["user_id"]
+        if LIKE_BUFFER_ENABLED:
+            like_buffer.unlike(user_id, tweet_id)
+            await after_commit(bump("feed"))
+            return RESULT_TRUE
         try:
             query = (
                 delete(likes_table)
@@ -155,31 +305,46 @@ def create_routes(app):
                 )
                 .returning(likes_table.c.tweet_id)
             )
-            deleted_like = db.execute(query).fetchone()
-            db.commit()
+            deleted_like = (await db.execute(query)).fetchone()
+            if deleted_like:
+                author_id = await db.scalar(
+                    change_like_count(tweet_id, -1).returning(Tweet.author_id)
+                )
+            await db.commit()
             if deleted_like:
+                await after_commit(
+                    bump("feed"),
+                    bus.publish(like_event(tweet_id, author_id, -1)),
+                )
                 return RESULT_TRUE
         except Exception:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect data"
             )
 
-    @app.post("/api/users/{user_id}/follow")
+    @app.post("/api/users/{user_id}/follow", dependencies=WRITE)
     async def follow_user(
         auth: Annotated[dict, Depends(check_authentication_key)],
         user_id: int,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
     ):
         """Follow another user by user id"""
-        follower_id = auth.get("user_id")
+        follower_id = auth["user_id"]
         try:
             query = (
                 insert(user_following)
                 .values(user_id=user_id, follower_id=follower_id)
                 .returning(user_following.c.user_id)
             )
-            result = db.execute(query).fetchone()
-            db.commit()
+            result = (await db.execute(query)).fetchone()
+            if result and TIMELINE_ENABLED:
+                await follow_author(db, follower_id, user_id)
+            await db.commit()
+            invalidate_following(follower_id)
+            await after_commit(
+                bump(f"following:{follower_id}"),
+                invalidate_profiles(follower_id, user_id),
+            )
             if result:
                 return RESULT_TRUE
         except Exception:
@@ -187,14 +352,34 @@ def create_routes(app):
                 status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect data"
             )
 
-    @app.delete("/api/users/{user_id}/follow")
+    @app.post("/api/follows:batch", dependencies=WRITE)
+    async def follow_users(
+        auth: Annotated[dict, Depends(check_authentication_key)],
+        batch: FollowsBatchIn,
+        db: AsyncSession = Depends(get_db),
+    ):
+        """Follow several users in one transaction"""
+        follower_id = auth["user_id"]
+        try:
+            items = await add_follows(
+                db, follower_id, batch.user_ids, fan_out=TIMELINE_ENABLED
+            )
+            await db.commit()
+            await after_commit(invalidate_follows(follower_id, items))
+            return {"items": items} | RESULT_TRUE
+        except Exception:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect data"
+            )
+
+    @app.delete("/api/users/{user_id}/follow", dependencies=WRITE)
     async def unfollow_user(
         auth: Annotated[dict, Depends(check_authentication_key)],
         user_id: int,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
     ):
         """Unfollow another user by user id"""
-        follower_id = auth.get("user_id")
+        follower_id = auth["user_id"]
         try:
             query = (
                 delete(user_following)
@@ -204,8 +389,15 @@ def create_routes(app):
                 )
                 .returning(user_following.c.user_id)
             )
-            deleted_following = db.execute(query).fetchone()
-            db.commit()
+            deleted_following = (await db.execute(query)).fetchone()
+            if deleted_following and TIMELINE_ENABLED:
+                await unfollow_author(db, follower_id, user_id)
+            await db.commit()
+            invalidate_following(follower_id)
+            await after_commit(
+                bump(f"following:{follower_id}"),
+                invalidate_profiles(follower_id, user_id),
+            )
             if deleted_following:
                 return RESULT_TRUE
         except Exception:
@@ -213,81 +405,144 @@ def create_routes(app):
                 status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect data"
             )
 
-    @app.get("/api/tweets")
+    @app.get("/api/tweets", response_model=FeedOut, dependencies=READ)
     async def get_tweet_feed(
+        request: Request,
         auth: Annotated[dict, Depends(check_authentication_key)],
-        db: Session = Depends(get_db),
+        limit: int = FEED_PAGE_SIZE,
+        cursor: Optional[str] = None,
+        db: AsyncSession = Depends(get_read_db),
+        primary: AsyncSession = Depends(get_primary_db),
     ):
         """Get tweet feed"""
-        user_id = auth.get("user_id")
+        user_id = auth["user_id"]
+        scopes = ["feed", f"following:{user_id}"]
+        etag = await make_etag(
+            scopes,
+            user_id,
+            limit,
+            cursor,
+            TIMELINE_ENABLED,
+            # the trending tier of the first page comes from this worker
+            trending.snapshot.version,
+        )
+        if not_modified(request, etag):
+            return not_modified_response(etag)
+        if await bumped_recently(*scopes):
+            # a replica may not have the write behind the ETag yet
+            db = primary
         try:
-            query = select(Tweet).options(joinedload(Tweet.attachments))
-            tweets = db.scalars(query).unique().all()
-            tweets_sorter_likes = sorted(
-                tweets, key=lambda x: len(x.likes), reverse=True
-            )
-            tweets_sorter_follower = sorted(
-                tweets_sorter_likes,
-                key=lambda x: (
-                    True
-                    if user_id in [u.id for u in x.author.followers]
-                    else False
-                ),
-                reverse=True,
-            )
-            tweets_result = [
-                {
-                    "id": tw.id,
-                    "content": tw.content,
-                    "attachments": [ta.link for ta in tw.attachments],
-                    "author": {"id": tw.author.id, "name": tw.author.name},
-                    "likes": [
-                        {"user_id": tl.id, "name": tl.name} for tl in tw.likes
-                    ],
-                }
-                for tw in tweets_sorter_follower
-            ]
-            return {"tweets": tweets_result} | RESULT_TRUE
+            get_page = get_timeline_page if TIMELINE_ENABLED else get_feed_page
+            tweets_result, next_cursor = await get_page(
+                db, user_id, limit, cursor
+            )
+            return TimedORJSONResponse(
+                {"tweets": tweets_result, "next_cursor": next_cursor}
+                | RESULT_TRUE,
+                headers=etag_headers(etag),
+            )
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST, detail=e.args[0]
             )
 
-    @app.get("/api/users/me")
+    @app.get("/api/tweets/stream", dependencies=READ)
+    async def stream_feed(
+        auth: Annotated[dict, Depends(check_authentication_key)],
+        db: AsyncSession = Depends(get_read_db),
+    ):
+        """Stream new tweets and like changes as server-sent events"""
+        if bus.full():
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many streams",
+            )
+        user_id = auth["user_id"]
+        following = await get_following(db, user_id)
+        return StreamingResponse(
+            event_stream(user_id, following),
+            media_type="text/event-stream",
+            # no buffering by nginx, or events would arrive in batches
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @app.get("/api/tweets/trending", response_model=FeedOut, dependencies=READ)
+    async def get_trending(
+        auth: Annotated[dict, Depends(check_authentication_key)],
+        limit: int = FEED_PAGE_SIZE,
+        db: AsyncSession = Depends(get_read_db),
+    ):
+        """Get the most liked tweets of late"""
+        tweets_result = await load_tweets(db, trending.snapshot.ids(limit))
+        return TimedORJSONResponse(
+            {"tweets": tweets_result, "next_cursor": None} | RESULT_TRUE
+        )
+
+    @app.get("/api/tweets/search", response_model=FeedOut, dependencies=READ)
+    async def search(
+        auth: Annotated[dict, Depends(check_authentication_key)],
+        q: Annotated[str, Query(min_length=1, max_length=256)],
+        limit: int = FEED_PAGE_SIZE,
+        cursor: Optional[str] = None,
+        db: AsyncSession = Depends(get_read_db),
+    ):
+        """Search tweets by content"""
+        try:
+            tweets_result, next_cursor = await search_tweets(
+                db, q, limit, cursor
+            )
+            return TimedORJSONResponse(
+                {"tweets": tweets_result, "next_cursor": next_cursor}
+                | RESULT_TRUE
+            )
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=e.args[0]
+            )
+
+    @app.get("/api/users/me", response_model=ProfileResponse, dependencies=READ)
     async def get_info_about_yourself(
+        request: Request,
         auth: Annotated[dict, Depends(check_authentication_key)],
-        db: Session = Depends(get_db),
-    ) -> Dict:
+        db: AsyncSession = Depends(get_primary_db),
+    ):
         """Get information about yourself"""
-        user_id = auth.get("user_id")
+        user_id = auth["user_id"]
+        etag = await make_etag([f"profile:{user_id}"], user_id)
+        if not_modified(request, etag):
+            return not_modified_response(etag)
         try:
-            query = (
-                select(User)
-                .options(joinedload(User.followers), joinedload(User.following))
-                .where(User.id == user_id)
+            profile = await get_profile(db, user_id)
+            if profile is None:
+                raise Exception
+            return TimedORJSONResponse(
+                {"user": profile} | RESULT_TRUE, headers=etag_headers(etag)
             )
-            user = db.scalar(query)
-            return {"user": jsonable_encoder(user)} | RESULT_TRUE
         except Exception:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST, detail="Not found"
             )
 
-    @app.get("/api/users/{user_id}")
+    @app.get(
+        "/api/users/{user_id}",
+        response_model=ProfileResponse,
+        dependencies=READ,
+    )
     async def get_info_by_id(
+        request: Request,
         user_id: int,
         auth: Annotated[dict, Depends(check_authentication_key)],
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_primary_db),
     ):
         """Get information anouther user by user id"""
+        etag = await make_etag([f"profile:{user_id}"], user_id)
+        if not_modified(request, etag):
+            return not_modified_response(etag)
         try:
-            query = (
-                select(User)
-                .options(joinedload(User.followers), joinedload(User.following))
-                .where(User.id == user_id)
+            profile = await get_profile(db, user_id)
+            return TimedORJSONResponse(
+                {"user": profile} | RESULT_TRUE, headers=etag_headers(etag)
             )
-            user = db.scalar(query)
-            return {"user": user} | RESULT_TRUE
         except Exception:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
@@ -1,8 +1,59 @@
-from typing import List
+import os
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 1000))
 
 
 class TweetIn(BaseModel):
     tweet_data: str
     tweet_media_ids: List[int]
+
+
+class TweetsBatchIn(BaseModel):
+    tweets: List[TweetIn] = Field(max_length=BATCH_MAX_SIZE)
+
+
+class LikesBatchIn(BaseModel):
+    tweet_ids: List[int] = Field(max_length=BATCH_MAX_SIZE)
+
+
+class FollowsBatchIn(BaseModel):
+    user_ids: List[int] = Field(max_length=BATCH_MAX_SIZE)
+
+
+class UserOut(BaseModel):
+    id: int
+    name: str
+
+
+class LikeOut(BaseModel):
+    user_id: int
+    name: str
+
+
+class TweetOut(BaseModel):
+    id: int
+    content: str
+    attachments: List[str]
+    # variant name -> format -> link, one mapping per attachment
+    attachment_variants: List[Dict[str, Dict[str, str]]]
+    author: UserOut
+    likes: List[LikeOut]
+
+
+class FeedOut(BaseModel):
+    result: bool = True
+    tweets: List[TweetOut]
+    next_cursor: Optional[str] = None
+
+
+class ProfileOut(UserOut):
+    followers: List[UserOut]
+    following: List[UserOut]
+
+
+class ProfileResponse(BaseModel):
+    result: bool = True
+    user: Optional[ProfileOut] = None
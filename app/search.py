@@ -0,0 +1,68 @@
+"""Full-text search over tweet content.
+
+tweets.search_vector is a generated tsvector column with a GIN index, so
+Postgres keeps it current on insert and a query only visits matching
+tweets. Results are ranked by ts_rank_cd, newest first on ties, and paged
+with a (rank, id) keyset cursor.
+"""
+
+import base64
+import binascii
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, literal, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.feed import FEED_MAX_PAGE_SIZE
+from app.loaders import load_tweets
+from app.models import Tweet
+
+SEARCH_CONFIG = "simple"
+
+Cursor = Tuple[float, int]
+
+
+def encode_search_cursor(rank: float, tweet_id: int) -> str:
+    """Pack the rank and id of the last result on a page; repr keeps the
+    rank exact, so the next page starts right after it"""
+    raw = f"{rank!r}:{tweet_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor: str) -> Cursor:
+    """Unpack a token produced by encode_search_cursor"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        rank, tweet_id = raw.split(":")
+        return float(rank), int(tweet_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def search_query(text: str, limit: int, cursor: Optional[Cursor] = None):
+    """Select (id, rank) of one page of tweets matching text"""
+    query = func.websearch_to_tsquery(SEARCH_CONFIG, text)
+    rank = func.ts_rank_cd(Tweet.search_vector, query)
+    page = select(Tweet.id, rank).where(
+        Tweet.search_vector.op("@@")(query), Tweet.deleted_at.is_(None)
+    )
+    if cursor is not None:
+        after = tuple_(literal(cursor[0]), literal(cursor[1]))
+        page = page.where(tuple_(rank, Tweet.id) < after)
+    return page.order_by(rank.desc(), Tweet.id.desc()).limit(limit)
+
+
+async def search_tweets(
+    db: AsyncSession, text: str, limit: int, cursor: Optional[str] = None
+) -> Tuple[List[Dict], Optional[str]]:
+    """Return one page of tweets matching text, best match first, and the
+    cursor of the next page"""
+    limit = max(1, min(limit, FEED_MAX_PAGE_SIZE))
+    position = decode_search_cursor(cursor) if cursor else None
+    rows = (await db.execute(search_query(text, limit, position))).all()
+    next_cursor = None
+    if len(rows) == limit:
+        tweet_id, rank = rows[-1]
+        next_cursor = encode_search_cursor(rank, tweet_id)
+    return await load_tweets(db, [row[0] for row in rows]), next_cursor
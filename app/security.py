@@ -1,29 +1,54 @@
+import os
 from typing import Dict
 
 from fastapi import Depends, HTTPException
 from fastapi.security import APIKeyHeader
 from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
-from app.database import get_db
+from app.cache import LRUCache
+from app.database import Session, get_read_db
 from app.models import Key, User
 
 API_KEY = APIKeyHeader(name="Api-Key")
 
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", 10000))
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 300))
+AUTH_CACHE_NEGATIVE_TTL = float(os.environ.get("AUTH_CACHE_NEGATIVE_TTL", 5))
 
-def check_authentication_key(
-    api_key: str = Depends(API_KEY), db: Session = Depends(get_db)
+# API key -> user id, None for keys that are known to be invalid
+auth_cache = LRUCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+
+def invalidate_api_key(api_key: str) -> None:
+    """Must be called when a key is revoked or reassigned"""
+    auth_cache.invalidate(api_key)
+
+
+async def check_authentication_key(
+    api_key: str = Depends(API_KEY), db: AsyncSession = Depends(get_read_db)
 ) -> Dict:
     """Takes the API-Key header and converts it into the matching user object
     from the database"""
-    try:
-        query = select(Key.user_id).where(Key.key == api_key)
-        user_id = db.scalar(query)
-    except Exception:
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="DB not responding",
+    found, user_id = auth_cache.get(api_key)
+    if not found:
+        try:
+            query = select(Key.user_id).where(Key.key == api_key)
+            user_id = await db.scalar(query)
+            if user_id is None and "replica" in db.info:
+                # a key just created may not have reached the replica; a
+                # miss is cached only once the primary agrees
+                async with Session() as primary:
+                    user_id = await primary.scalar(query)
+        except Exception:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="DB not responding",
+            )
+        auth_cache.set(
+            api_key, user_id, None if user_id else AUTH_CACHE_NEGATIVE_TTL
         )
     if user_id:
         return {"user_id": user_id}
@@ -33,13 +58,17 @@ def check_authentication_key(
     )
 
 
-def create_first_user_for_login(db: Session):
+async def create_first_user_for_login(db: AsyncSession):
     query = select(Key).where(Key.key == "test")
-    result_key = db.scalars(query).one_or_none()
+    result_key = (await db.scalars(query)).one_or_none()
     if result_key is None:
+        # one transaction, so workers starting together cannot leave a
+        # user without its key behind
         user = User(name="first user")
         db.add(user)
-        db.commit()
-        key = Key(user_id=user.id, key="test")
-        db.add(key)
-        db.commit()
+        await db.flush()
+        db.add(Key(user_id=user.id, key="test"))
+        try:
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
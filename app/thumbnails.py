@@ -0,0 +1,137 @@
+"""Resized and recompressed variants of uploaded images.
+
+Images are decoded and re-encoded in a pool of worker processes, so the
+work never competes with request handling for the GIL. Variant files are
+named after the source blob (medias/variants/<sha[:2]>/<sha>-thumb.webp),
+so a blob that was uploaded many times is rendered once.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from PIL import Image, ImageOps
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession
+
+from app.database import WEB_CONCURRENCY
+from app.media import MEDIA_DIR, media_path
+from app.models import MediaVariant
+
+logger = logging.getLogger(__name__)
+
+# image processes of one web worker; by default all web workers together
+# get one per core
+THUMBNAIL_WORKERS = int(
+    os.environ.get(
+        "THUMBNAIL_WORKERS",
+        max(1, (os.cpu_count() or 1) // max(1, WEB_CONCURRENCY)),
+    )
+)
+VARIANT_SIZES = {"thumb": (320, 320), "medium": (1080, 1080)}
+VARIANT_FORMATS = {
+    "webp": ("WEBP", "webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "jpg", {"quality": 82, "optimize": True}),
+}
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn, not fork: the server process runs threads and an event loop
+        _executor = ProcessPoolExecutor(
+            max_workers=THUMBNAIL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+
+def render_variants(source: str, target_dir: str, stem: str) -> List[Dict]:
+    """Write every size/format variant of an image and describe them.
+    Runs in a worker process."""
+    Path(target_dir).mkdir(parents=True, exist_ok=True)
+    variants = []
+    with Image.open(source) as original:
+        ImageOps.exif_transpose(original, in_place=True)
+        image = original
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        for name, size in VARIANT_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail(size, Image.Resampling.LANCZOS)
+            for fmt, encoder in VARIANT_FORMATS.items():
+                pil_format, extension, options = encoder
+                filename = f"{stem}-{name}.{extension}"
+                target = Path(target_dir) / filename
+                if not target.exists():
+                    frame = resized if fmt == "webp" else resized.convert("RGB")
+                    partial = target.with_name(f".{filename}.{os.getpid()}")
+                    frame.save(partial, pil_format, **options)
+                    os.replace(partial, target)
+                variants.append(
+                    {
+                        "name": name,
+                        "format": fmt,
+                        "filename": filename,
+                        "width": resized.width,
+                        "height": resized.height,
+                    }
+                )
+    return variants
+
+
+async def create_variants(
+    media_id: int, link: str, bind: Union[AsyncEngine, AsyncConnection]
+) -> List[Dict]:
+    """Render the variants of an uploaded media file and record them through
+    the engine that served the upload"""
+    stem = Path(link).stem
+    target_dir = Path(MEDIA_DIR) / "variants" / stem[:2]
+    loop = asyncio.get_running_loop()
+    try:
+        rendered = await loop.run_in_executor(
+            get_executor(),
+            render_variants,
+            str(media_path(link)),
+            str(target_dir),
+            stem,
+        )
+    except Exception as e:
+        logger.info("No variants for media %s: %r", media_id, e)
+        return []
+
+    rows = [
+        {
+            "media_id": media_id,
+            "name": variant["name"],
+            "format": variant["format"],
+            "link": f"medias/variants/{stem[:2]}/{variant['filename']}",
+            "width": variant["width"],
+            "height": variant["height"],
+        }
+        for variant in rendered
+    ]
+    async with AsyncSession(bind) as db:
+        try:
+            await db.execute(
+                insert(MediaVariant).values(rows).on_conflict_do_nothing()
+            )
+            await db.commit()
+        except IntegrityError:
+            logger.info("Media %s was deleted before its variants", media_id)
+            return []
+    return rows
@@ -0,0 +1,291 @@
+"""Materialized home timelines (fan-out-on-write).
+
+Every tweet id is pushed into the `timelines` rows of the author and of
+each follower when it is written, so reading a page of a home timeline is
+a single index range scan. Authors with more than TIMELINE_FANOUT_LIMIT
+followers are not fanned out; their tweets are merged in at read time.
+Fan-out does not look at the length of the timelines it writes to; the
+cleanup task (see app.cleanup) trims the timelines that received tweets
+since its previous run back to TIMELINE_DEPTH entries, and follow_author
+trims the one timeline it fills.
+
+Rebuild all timelines from tweets and user_following with:
+
+    python -m app.timeline backfill
+"""
+
+import argparse
+import asyncio
+import os
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import (
+    SelectBase,
+    delete,
+    func,
+    literal,
+    select,
+    true,
+    union,
+    union_all,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from app.database import Session as DBSession
+from app.database import engine
+from app.feed import FEED_MAX_PAGE_SIZE
+from app.loaders import load_tweets
+from app.models import TimelineEntry, Tweet, User, user_following
+
+TIMELINE_ENABLED = os.environ.get("TIMELINE_ENABLED") == "1"
+TIMELINE_FANOUT_LIMIT = int(os.environ.get("TIMELINE_FANOUT_LIMIT", 10000))
+TIMELINE_DEPTH = int(os.environ.get("TIMELINE_DEPTH", 800))
+
+
+def _has_many_followers(author_id):
+    """EXISTS clause that stops scanning after TIMELINE_FANOUT_LIMIT rows"""
+    followers = aliased(user_following)
+    return (
+        select(followers.c.user_id)
+        .where(followers.c.user_id == author_id)
+        .offset(TIMELINE_FANOUT_LIMIT)
+        .limit(1)
+        .exists()
+    )
+
+
+async def is_fanout_author(db: AsyncSession, author_id: int) -> bool:
+    """Whether tweets of the author are pushed into followers' timelines"""
+    return not await db.scalar(select(_has_many_followers(author_id)))
+
+
+async def fan_out_tweet(
+    db: AsyncSession, tweet_id: int, author_id: int
+) -> None:
+    """Push a new tweet into the timelines of its author and followers"""
+    recipients: SelectBase = select(literal(author_id))
+    if await is_fanout_author(db, author_id):
+        recipients = union_all(
+            recipients,
+            select(user_following.c.follower_id).where(
+                user_following.c.user_id == author_id
+            ),
+        )
+    rows = select(
+        recipients.subquery().c[0],
+        literal(tweet_id),
+        literal(author_id),
+    )
+    await db.execute(
+        insert(TimelineEntry)
+        .from_select(["user_id", "tweet_id", "author_id"], rows)
+        .on_conflict_do_nothing()
+    )
+
+
+async def follow_author(
+    db: AsyncSession, follower_id: int, author_id: int
+) -> None:
+    """Copy the latest tweets of a newly followed author into a timeline"""
+    if not await is_fanout_author(db, author_id):
+        return
+    rows = (
+        select(literal(follower_id), Tweet.id, Tweet.author_id)
+        .where(Tweet.author_id == author_id, Tweet.deleted_at.is_(None))
+        .order_by(Tweet.id.desc())
+        .limit(TIMELINE_DEPTH)
+    )
+    await db.execute(
+        insert(TimelineEntry)
+        .from_select(["user_id", "tweet_id", "author_id"], rows)
+        .on_conflict_do_nothing()
+    )
+    await db.execute(_trim([follower_id], TIMELINE_DEPTH))
+
+
+async def unfollow_author(
+    db: AsyncSession, follower_id: int, author_id: int
+) -> None:
+    """Drop the tweets of an unfollowed author from a timeline"""
+    await db.execute(
+        delete(TimelineEntry).where(
+            TimelineEntry.user_id == follower_id,
+            TimelineEntry.author_id == author_id,
+        )
+    )
+
+
+def _trim(user_ids, depth: int):
+    """DELETE of the entries beyond depth from the timelines of user_ids, a
+    list or a select of ids"""
+    # the newest entry past depth of each timeline, found from the index
+    kept = TimelineEntry.__table__.alias("kept")
+    cutoff = (
+        select(kept.c.tweet_id)
+        .where(kept.c.user_id == User.id)
+        .order_by(kept.c.tweet_id.desc())
+        .offset(depth)
+        .limit(1)
+        .lateral()
+    )
+    cutoffs = (
+        select(User.id.label("user_id"), cutoff.c.tweet_id)
+        .join(cutoff, true())
+        .where(User.id.in_(user_ids))
+        .subquery()
+    )
+    return delete(TimelineEntry).where(
+        TimelineEntry.user_id == cutoffs.c.user_id,
+        TimelineEntry.tweet_id <= cutoffs.c.tweet_id,
+    )
+
+
+async def trim_timelines(
+    db: AsyncSession,
+    after: int = 0,
+    batch_size: int = 500,
+    depth: int = TIMELINE_DEPTH,
+) -> Optional[int]:
+    """Drop the entries beyond depth from the timelines of the next
+    batch_size users with ids above after and commit; return the last of
+    those ids, or None when no user is left"""
+    user_ids = list(
+        await db.scalars(
+            select(User.id)
+            .where(User.id > after)
+            .order_by(User.id)
+            .limit(batch_size)
+        )
+    )
+    if not user_ids:
+        return None
+    await db.execute(_trim(user_ids, depth))
+    await db.commit()
+    return user_ids[-1]
+
+
+async def trim_fanned_out(
+    db: AsyncSession, after: Optional[int], depth: int = TIMELINE_DEPTH
+) -> int:
+    """Drop the entries beyond depth from the timelines that fan_out_tweet
+    pushed tweets with ids above after into, without committing; return
+    the id of the newest tweet, the `after` of the next call. Nothing is
+    trimmed when after is None."""
+    last = await db.scalar(select(func.max(Tweet.id)))
+    if last is None or after is None or last <= after:
+        return last or 0
+    new = Tweet.id.between(after + 1, last)
+    authors = select(Tweet.author_id).where(new)
+    followers = select(user_following.c.follower_id).where(
+        user_following.c.user_id.in_(
+            select(Tweet.author_id)
+            .where(new, ~_has_many_followers(Tweet.author_id))
+            .distinct()
+        )
+    )
+    await db.execute(_trim(union(authors, followers), depth))
+    return last
+
+
+async def get_timeline_page(
+    db: AsyncSession, user_id: int, limit: int, cursor: Optional[str] = None
+) -> Tuple[List[Dict], Optional[str]]:
+    """Return one page of the home timeline, newest first, and the cursor
+    of the next page"""
+    limit = max(1, min(limit, FEED_MAX_PAGE_SIZE))
+    try:
+        before = int(cursor) if cursor else None
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+    # deleted tweets keep their entries until app.cleanup reaps them
+    stored = (
+        select(TimelineEntry.tweet_id)
+        .join(Tweet, Tweet.id == TimelineEntry.tweet_id)
+        .where(TimelineEntry.user_id == user_id, Tweet.deleted_at.is_(None))
+    )
+    if before is not None:
+        stored = stored.where(TimelineEntry.tweet_id < before)
+    tweet_ids = list(
+        await db.scalars(
+            stored.order_by(TimelineEntry.tweet_id.desc()).limit(limit)
+        )
+    )
+
+    # fan-out-on-read for followed authors that were skipped on write
+    skipped_authors = select(user_following.c.user_id).where(
+        user_following.c.follower_id == user_id,
+        _has_many_followers(user_following.c.user_id),
+    )
+    merged = select(Tweet.id).where(
+        Tweet.author_id.in_(skipped_authors), Tweet.deleted_at.is_(None)
+    )
+    if before is not None:
+        merged = merged.where(Tweet.id < before)
+    tweet_ids += await db.scalars(merged.order_by(Tweet.id.desc()).limit(limit))
+
+    tweet_ids = sorted(set(tweet_ids), reverse=True)[:limit]
+    next_cursor = str(tweet_ids[-1]) if len(tweet_ids) == limit else None
+    return await load_tweets(db, tweet_ids), next_cursor
+
+
+async def rebuild_timelines(
+    db: AsyncSession, depth: int = TIMELINE_DEPTH
+) -> int:
+    """Recreate every timeline from tweets and user_following"""
+    followers = aliased(user_following)
+    edges = union_all(
+        select(User.id.label("user_id"), User.id.label("author_id")),
+        select(
+            followers.c.follower_id.label("user_id"),
+            followers.c.user_id.label("author_id"),
+        ).where(~_has_many_followers(followers.c.user_id)),
+    ).subquery()
+    ranked = (
+        select(
+            edges.c.user_id,
+            Tweet.id.label("tweet_id"),
+            Tweet.author_id,
+            func.row_number()
+            .over(partition_by=edges.c.user_id, order_by=Tweet.id.desc())
+            .label("position"),
+        )
+        .join(Tweet, Tweet.author_id == edges.c.author_id)
+        .where(Tweet.deleted_at.is_(None))
+        .subquery()
+    )
+    rows = select(
+        ranked.c.user_id, ranked.c.tweet_id, ranked.c.author_id
+    ).where(ranked.c.position <= depth)
+    await db.execute(delete(TimelineEntry))
+    result = await db.execute(
+        insert(TimelineEntry).from_select(
+            ["user_id", "tweet_id", "author_id"], rows
+        )
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def backfill_timelines(depth: int) -> None:
+    async with DBSession() as db:
+        count = await rebuild_timelines(db, depth)
+    await engine.dispose()
+    print(f"{count} timeline entries written")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.timeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill = commands.add_parser(
+        "backfill", help="rebuild home timelines from the existing tables"
+    )
+    backfill.add_argument("--depth", type=int, default=TIMELINE_DEPTH)
+    args = parser.parse_args()
+    asyncio.run(backfill_timelines(args.depth))
+
+
+if __name__ == "__main__":
+    main()
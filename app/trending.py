@@ -0,0 +1,256 @@
+"""Trending tweets: the top TRENDING_SIZE tweets by time-decayed likes.
+
+A like given `age` seconds ago weighs 2 ** (-age / TRENDING_HALF_LIFE).
+Weights are kept relative to a fixed epoch, 2 ** ((given - epoch) /
+half_life), so scores never have to be decayed in place: a new like simply
+adds a larger weight, and the order of all scores stays right as time
+passes.
+
+With TRENDING_ENABLED=1 the feed ranks these tweets after those of the
+followed authors, and a background task started by the lifespan of the app
+keeps the scores of this worker up to date:
+
+- every TRENDING_REBUILD_INTERVAL seconds it recomputes them in one
+  aggregate over the likes of the last TRENDING_HORIZON seconds, with the
+  epoch moved to now; this also forgets removed likes and deleted tweets;
+- every TRENDING_REFRESH_INTERVAL seconds in between it reads only the
+  likes given since the previous read and adds their weights.
+
+A like is stamped with the start of its transaction, so one may commit
+after a read that already went past its timestamp. Reads therefore reach
+TRENDING_LAG seconds back and skip the likes they have already counted.
+
+After each refresh the top tweets are published as a new immutable
+Snapshot, replacing the previous one in a single assignment, so readers
+never wait for a refresh or see one half done. Only the best
+TRENDING_CANDIDATES scores are kept between refreshes. Times come from the
+database clock, so every worker agrees on them.
+
+A snapshot is versioned by the time, in milliseconds, of the refresh that
+first published its order. Each new order is also kept in the CACHE_URL
+backend for TRENDING_SNAPSHOT_TTL seconds, so the feed can page through the
+snapshot its first page was ranked with on any worker and after later
+refreshes; the feed ETag carries the version instead of each worker
+bumping the shared "feed" token. Without CACHE_URL a worker only knows its
+own snapshots, and a cursor from another worker moves to its current one.
+"""
+
+import asyncio
+import heapq
+import logging
+import os
+from dataclasses import dataclass
+from datetime import timedelta
+from operator import itemgetter
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.cache import CACHE_URL, create_backend
+from app.database import Session as DBSession
+from app.models import Tweet, likes_table
+
+TRENDING_ENABLED = os.environ.get("TRENDING_ENABLED") == "1"
+TRENDING_SIZE = int(os.environ.get("TRENDING_SIZE", 100))
+TRENDING_CANDIDATES = 10 * TRENDING_SIZE
+TRENDING_HALF_LIFE = float(os.environ.get("TRENDING_HALF_LIFE", 6 * 3600))
+TRENDING_HORIZON = float(os.environ.get("TRENDING_HORIZON", 48 * 3600))
+TRENDING_REFRESH_INTERVAL = float(
+    os.environ.get("TRENDING_REFRESH_INTERVAL", 10)
+)
+TRENDING_REBUILD_INTERVAL = float(
+    os.environ.get("TRENDING_REBUILD_INTERVAL", 3600)
+)
+# longest expected like transaction, in seconds
+TRENDING_LAG = 60
+TRENDING_SNAPSHOT_TTL = float(os.environ.get("TRENDING_SNAPSHOT_TTL", 3600))
+
+logger = logging.getLogger(__name__)
+
+# ids of recent snapshots by version
+snapshots = create_backend(
+    CACHE_URL, ttl=TRENDING_SNAPSHOT_TTL, prefix="microblog:trending:"
+)
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    # (tweet_id, decayed like count at refreshed_at), best first
+    entries: Tuple[Tuple[int, float], ...] = ()
+    refreshed_at: float = 0.0
+    # refreshed_at in ms of the first snapshot with this order
+    version: int = 0
+
+    def ids(self, limit: Optional[int] = None) -> List[int]:
+        return [tweet_id for tweet_id, _ in self.entries[:limit]]
+
+
+def _db_clock():
+    return func.extract("epoch", func.now())
+
+
+class Trending:
+    """Decayed like scores of this worker and the snapshot of their top"""
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker = DBSession,
+        size: int = TRENDING_SIZE,
+    ):
+        self.session_factory = session_factory
+        self.size = size
+        self.snapshot = Snapshot()
+        self.scores: Dict[int, float] = {}
+        self.epoch: Optional[float] = None
+        self.since = 0.0
+        # likes read within TRENDING_LAG of `since`: (user, tweet) -> given
+        self.seen: Dict[Tuple[int, int], float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def _weight(self, given: float) -> float:
+        assert self.epoch is not None, "weights need a rebuild first"
+        return 2 ** ((given - self.epoch) / TRENDING_HALF_LIFE)
+
+    def _recent_likes(self, after: float):
+        return (
+            select(
+                likes_table.c.user_id,
+                likes_table.c.tweet_id,
+                func.extract("epoch", likes_table.c.created_at),
+            )
+            .join(Tweet, Tweet.id == likes_table.c.tweet_id)
+            .where(
+                likes_table.c.created_at > func.to_timestamp(after),
+                Tweet.deleted_at.is_(None),
+            )
+        )
+
+    async def rebuild(self, db: AsyncSession) -> None:
+        """Recompute every score from the likes within TRENDING_HORIZON"""
+        now = float((await db.execute(select(_db_clock()))).scalar_one())
+        weight = func.power(
+            2,
+            (func.extract("epoch", likes_table.c.created_at) - now)
+            / TRENDING_HALF_LIFE,
+        )
+        query = (
+            select(likes_table.c.tweet_id, func.sum(weight))
+            .join(Tweet, Tweet.id == likes_table.c.tweet_id)
+            .where(
+                likes_table.c.created_at
+                > func.now() - timedelta(seconds=TRENDING_HORIZON),
+                Tweet.deleted_at.is_(None),
+            )
+            .group_by(likes_table.c.tweet_id)
+        )
+        self.scores = {
+            tweet_id: float(score)
+            for tweet_id, score in await db.execute(query)
+        }
+        self.epoch = now
+        self.seen = {
+            (user_id, tweet_id): float(given)
+            for user_id, tweet_id, given in await db.execute(
+                self._recent_likes(now - TRENDING_LAG)
+            )
+        }
+        self.since = now
+        await db.rollback()
+
+    async def update(self, db: AsyncSession) -> int:
+        """Add the likes given since the last read; return how many"""
+        now = float((await db.execute(select(_db_clock()))).scalar_one())
+        added = 0
+        for user_id, tweet_id, given in await db.execute(
+            self._recent_likes(self.since - TRENDING_LAG)
+        ):
+            given = float(given)
+            if self.seen.get((user_id, tweet_id)) == given:
+                continue
+            self.seen[(user_id, tweet_id)] = given
+            score = self.scores.get(tweet_id, 0.0)
+            self.scores[tweet_id] = score + self._weight(given)
+            added += 1
+        self.since = now
+        self.seen = {
+            pair: given
+            for pair, given in self.seen.items()
+            if given > now - TRENDING_LAG
+        }
+        await db.rollback()
+        return added
+
+    def publish(self) -> bool:
+        """Swap in a snapshot of the current top; return whether its order
+        changed"""
+        if len(self.scores) > TRENDING_CANDIDATES:
+            self.scores = dict(
+                heapq.nlargest(
+                    TRENDING_CANDIDATES, self.scores.items(), itemgetter(1)
+                )
+            )
+        top = heapq.nlargest(self.size, self.scores.items(), itemgetter(1))
+        # scale from the epoch to the time of the last read
+        scale = self._weight(self.since) if self.epoch is not None else 1.0
+        changed = [tweet_id for tweet_id, _ in top] != self.snapshot.ids()
+        self.snapshot = Snapshot(
+            tuple((tweet_id, score / scale) for tweet_id, score in top),
+            self.since,
+            round(self.since * 1000) if changed else self.snapshot.version,
+        )
+        return changed
+
+    async def refresh(self, rebuild: bool = False) -> bool:
+        """Read new likes, or rebuild, and publish a snapshot; return
+        whether the order of the top changed"""
+        async with self.session_factory() as db:
+            if rebuild or self.epoch is None:
+                await self.rebuild(db)
+            else:
+                await self.update(db)
+        changed = self.publish()
+        if changed:
+            await snapshots.set(str(self.snapshot.version), self.snapshot.ids())
+        return changed
+
+    async def pinned(self, version: Optional[int]) -> Tuple[int, List[int]]:
+        """Version and ids of the snapshot of `version` while it is kept,
+        else of the current snapshot"""
+        snapshot = self.snapshot
+        if version is not None and version != snapshot.version:
+            ids = await snapshots.get(str(version))
+            if ids is not None:
+                return version, ids
+        return snapshot.version, snapshot.ids()
+
+    async def run(self) -> None:
+        rebuilt_at = None
+        loop = asyncio.get_running_loop()
+        while True:
+            rebuild = (
+                rebuilt_at is None
+                or loop.time() - rebuilt_at >= TRENDING_REBUILD_INTERVAL
+            )
+            try:
+                await self.refresh(rebuild)
+                if rebuild:
+                    rebuilt_at = loop.time()
+            except Exception:
+                logger.exception("Trending refresh failed")
+            await asyncio.sleep(TRENDING_REFRESH_INTERVAL)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+trending = Trending()
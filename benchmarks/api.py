@@ -0,0 +1,224 @@
+"""Latency and throughput of the API endpoints on seeded datasets.
+
+For every dataset size the database is reseeded with benchmarks.seed, then
+each scenario sends `--requests` requests from `--concurrency` concurrent
+clients, each request as a random seeded user, and reports req/s and
+p50/p95/p99 latency:
+
+    python -m benchmarks.api --sizes 1000 10000 --requests 500
+
+By default the app is served in-process through httpx's ASGI transport,
+which measures the app and the database without a network hop. Pass
+--url http://localhost to measure a running deployment instead; the
+deployment must use the database that the PG_* variables point to.
+"""
+
+import argparse
+import asyncio
+import io
+import random
+import statistics
+import time
+from typing import Callable, Dict, List
+
+import httpx
+from PIL import Image
+
+from benchmarks import seed
+
+
+def small_jpeg() -> bytes:
+    buffer = io.BytesIO()
+    Image.effect_noise((640, 480), 64).convert("RGB").save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def scenarios(users: int, tweets: int) -> Dict[str, Callable]:
+    photo = small_jpeg()
+
+    def headers(rng: random.Random) -> Dict[str, str]:
+        return {"Api-Key": seed.api_key(rng.randint(1, users))}
+
+    async def feed(client, rng):
+        return await client.get("/api/tweets", headers=headers(rng))
+
+    async def feed_second_page(client, rng):
+        auth = headers(rng)
+        first = (await client.get("/api/tweets", headers=auth)).json()
+        params = (
+            {"cursor": first["next_cursor"]} if first["next_cursor"] else {}
+        )
+        return await client.get("/api/tweets", params=params, headers=auth)
+
+    async def me(client, rng):
+        return await client.get("/api/users/me", headers=headers(rng))
+
+    async def profile(client, rng):
+        user_id = rng.randint(1, users)
+        return await client.get(f"/api/users/{user_id}", headers=headers(rng))
+
+    async def search(client, rng):
+        params = {"q": rng.choice(["walrus", "postgres coffee", "music"])}
+        return await client.get(
+            "/api/tweets/search", params=params, headers=headers(rng)
+        )
+
+    async def like(client, rng):
+        tweet_id = rng.randint(1, max(tweets, 1))
+        return await client.post(
+            f"/api/tweets/{tweet_id}/likes", headers=headers(rng)
+        )
+
+    async def auth_failure(client, rng):
+        return await client.get("/api/users/me", headers={"Api-Key": "none"})
+
+    async def upload(client, rng):
+        files = {"file": ("photo.jpg", photo, "image/jpeg")}
+        return await client.post(
+            "/api/medias", files=files, headers=headers(rng)
+        )
+
+    return {
+        "GET /api/tweets": feed,
+        "GET /api/tweets (page 2)": feed_second_page,
+        "GET /api/users/me": me,
+        "GET /api/users/{id}": profile,
+        "GET /api/tweets/search": search,
+        "POST /api/tweets/{id}/likes": like,
+        "bad api key": auth_failure,
+        "POST /api/medias": upload,
+    }
+
+
+def percentile(timings: List[float], share: float) -> float:
+    return statistics.quantiles(timings, n=100, method="inclusive")[
+        int(share * 100) - 1
+    ]
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    scenario: Callable,
+    requests: int,
+    concurrency: int,
+    rng: random.Random,
+) -> Dict[str, float]:
+    timings: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await scenario(client, rng)
+            timings.append(time.perf_counter() - start)
+            if response.status_code >= 500:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "req/s": requests / elapsed,
+        "p50": percentile(timings, 0.50) * 1000,
+        "p95": percentile(timings, 0.95) * 1000,
+        "p99": percentile(timings, 0.99) * 1000,
+        "errors": errors,
+    }
+
+
+def make_client(url: str) -> httpx.AsyncClient:
+    if url:
+        return httpx.AsyncClient(base_url=url, timeout=60)
+    from app.main import app
+
+    transport = httpx.ASGITransport(app=app)
+    return httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=60
+    )
+
+
+async def clear_caches() -> None:
+    """Forget what the in-process app cached about the previous dataset"""
+    from app.follow_graph import following_cache
+    from app.profiles import profile_cache
+    from app.security import auth_cache
+
+    auth_cache.clear()
+    following_cache.clear()
+    await profile_cache.clear()
+
+
+async def benchmark(args, size: int) -> None:
+    if not args.url:
+        await clear_caches()
+    async with seed.Session() as db:
+        await seed.reset(db)
+        counts = await seed.seed(
+            db,
+            users=size,
+            tweets_per_user=args.tweets_per_user,
+            follows_per_user=args.follows_per_user,
+            likes_per_tweet=args.likes_per_tweet,
+            media_share=args.media_share,
+            exponent=args.exponent,
+            seed=args.seed,
+        )
+    print(
+        f"\n{size} users, {counts['tweets']} tweets, {counts['follows']} "
+        f"follows, {counts['likes']} likes"
+    )
+    print(
+        f"{'scenario':<30} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'5xx':>5}"
+    )
+    rng = random.Random(args.seed)
+    available = scenarios(size, counts["tweets"])
+    async with make_client(args.url) as client:
+        for name, scenario in available.items():
+            if args.only and not any(part in name for part in args.only):
+                continue
+            # warm the pool and caches up with a few untimed requests
+            for _ in range(min(args.concurrency, 10)):
+                await scenario(client, rng)
+            stats = await run_scenario(
+                client, scenario, args.requests, args.concurrency, rng
+            )
+            print(
+                f"{name:<30} {stats['req/s']:>8.1f} {stats['p50']:>8.1f} "
+                f"{stats['p95']:>8.1f} {stats['p99']:>8.1f} "
+                f"{stats['errors']:>5}"
+            )
+
+
+async def run(args) -> None:
+    if not args.url:
+        from app.main import app
+
+        async with app.router.lifespan_context(app):
+            for size in args.sizes:
+                await benchmark(args, size)
+    else:
+        for size in args.sizes:
+            await benchmark(args, size)
+    await seed.engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.api")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--url", default="")
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        help="run only the scenarios whose name contains one of these",
+    )
+    seed.add_arguments(parser)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Throughput of the sync (psycopg2) and async (asyncpg) database paths
+under concurrent requests.
+
+The sync path reproduces what the routes did before the async layer: a
+blocking Session call inside an `async def` handler, which stalls the event
+loop for the whole round-trip. Each simulated request runs the auth lookup
+followed by `pg_sleep(latency)` to stand in for query/network time.
+
+    python -m benchmarks.db_concurrency --requests 400 --latency 0.005
+"""
+
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database import database_url
+from app.models import Key
+
+CONCURRENCY_LEVELS = (1, 4, 16, 64)
+
+
+async def run_sync_path(session_factory, requests, concurrency, latency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handler():
+        async with semaphore:
+            with session_factory() as db:
+                db.scalar(select(Key.user_id).where(Key.key == "test"))
+                db.execute(select(func.pg_sleep(latency)))
+
+    await asyncio.gather(*(handler() for _ in range(requests)))
+
+
+async def run_async_path(session_factory, requests, concurrency, latency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handler():
+        async with semaphore:
+            async with session_factory() as db:
+                await db.scalar(select(Key.user_id).where(Key.key == "test"))
+                await db.execute(select(func.pg_sleep(latency)))
+
+    await asyncio.gather(*(handler() for _ in range(requests)))
+
+
+async def measure(path, session_factory, requests, concurrency, latency):
+    start = time.perf_counter()
+    await path(session_factory, requests, concurrency, latency)
+    return requests / (time.perf_counter() - start)
+
+
+async def main(requests: int, latency: float) -> None:
+    pool = {"pool_size": max(CONCURRENCY_LEVELS), "max_overflow": 0}
+    sync_engine = create_engine(database_url("psycopg2"), **pool)
+    async_engine = create_async_engine(database_url(), **pool)
+    sync_session = sessionmaker(bind=sync_engine)
+    async_session = async_sessionmaker(bind=async_engine)
+
+    print(f"{'concurrency':>11} {'sync req/s':>11} {'async req/s':>12}")
+    for concurrency in CONCURRENCY_LEVELS:
+        sync_rps = await measure(
+            run_sync_path, sync_session, requests, concurrency, latency
+        )
+        async_rps = await measure(
+            run_async_path, async_session, requests, concurrency, latency
+        )
+        print(f"{concurrency:>11} {sync_rps:>11.1f} {async_rps:>12.1f}")
+
+    sync_engine.dispose()
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.db_concurrency")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.005,
+        help="seconds of simulated query time per request",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.latency))
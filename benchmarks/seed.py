@@ -0,0 +1,206 @@
+"""Synthetic dataset for the API benchmarks.
+
+Fills the database configured by the PG_* variables with `users` users,
+each with the api key "bench-<id>", a follow graph whose in-degrees follow
+a power law (a few celebrities, a long tail of users with almost no
+followers), tweets whose authors are drawn from the same distribution,
+likes that favour popular tweets and media attached to a share of tweets:
+
+    python -m benchmarks.seed --users 10000 --reset
+
+The schema must be migrated first. --reset truncates every table.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from itertools import accumulate
+from typing import Iterator, List, Sequence
+
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import Session, engine
+from app.likes import reconcile_like_counts
+from app.models import Key, Media, Tweet, User, likes_table, user_following
+from app.timeline import rebuild_timelines
+
+CHUNK_SIZE = 5000
+TABLES = (
+    "media_variants",
+    "medias",
+    "timelines",
+    "likes",
+    "user_following",
+    "tweets",
+    "keys",
+    "users",
+)
+
+
+def api_key(user_id: int) -> str:
+    return f"bench-{user_id}"
+
+
+def power_law_weights(count: int, exponent: float) -> List[float]:
+    """Cumulative weights of ranks 1..count for rng.choices, rank r being
+    picked with probability proportional to r ** -exponent"""
+    return list(accumulate(rank**-exponent for rank in range(1, count + 1)))
+
+
+def chunks(rows: Sequence, size: int = CHUNK_SIZE) -> Iterator[Sequence]:
+    for start in range(0, len(rows), size):
+        yield rows[start : start + size]
+
+
+async def insert_rows(db: AsyncSession, table, rows: Sequence) -> None:
+    for chunk in chunks(rows):
+        await db.execute(insert(table), list(chunk))
+
+
+async def seed(
+    db: AsyncSession,
+    users: int,
+    tweets_per_user: float,
+    follows_per_user: float,
+    likes_per_tweet: float,
+    media_share: float,
+    exponent: float,
+    seed: int,
+) -> dict:
+    rng = random.Random(seed)
+    user_ids = list(range(1, users + 1))
+    # popularity rank of each user, shuffled so it does not follow the id
+    popular = rng.sample(user_ids, users)
+    weights = power_law_weights(users, exponent)
+
+    await insert_rows(
+        db, User, [{"id": id, "name": f"user{id}"} for id in user_ids]
+    )
+    await insert_rows(
+        db, Key, [{"user_id": id, "key": api_key(id)} for id in user_ids]
+    )
+
+    edges = set()
+    for follower_id in user_ids:
+        wanted = min(users - 1, int(rng.expovariate(1 / follows_per_user)))
+        for followee_id in rng.choices(popular, cum_weights=weights, k=wanted):
+            if followee_id != follower_id:
+                edges.add((followee_id, follower_id))
+    await insert_rows(
+        db,
+        user_following,
+        [{"user_id": u, "follower_id": f} for u, f in edges],
+    )
+
+    tweet_count = int(users * tweets_per_user)
+    authors = rng.choices(popular, cum_weights=weights, k=tweet_count)
+    words = ["walrus", "python", "postgres", "coffee", "river", "music"]
+    await insert_rows(
+        db,
+        Tweet,
+        [
+            {
+                "id": id,
+                "author_id": author_id,
+                "content": " ".join(rng.choices(words, k=rng.randrange(3, 20))),
+            }
+            for id, author_id in enumerate(authors, start=1)
+        ],
+    )
+
+    tweet_ids = list(range(1, tweet_count + 1))
+    likes = set()
+    if tweet_ids:
+        tweet_weights = power_law_weights(tweet_count, exponent)
+        liked = rng.sample(tweet_ids, tweet_count)
+        for tweet_id in rng.choices(
+            liked,
+            cum_weights=tweet_weights,
+            k=int(tweet_count * likes_per_tweet),
+        ):
+            likes.add((rng.choice(user_ids), tweet_id))
+    await insert_rows(
+        db, likes_table, [{"user_id": u, "tweet_id": t} for u, t in likes]
+    )
+
+    media = [
+        {"tweet_id": tweet_id, "link": f"medias/seed/{tweet_id}.jpg"}
+        for tweet_id in tweet_ids
+        if rng.random() < media_share
+    ]
+    await insert_rows(db, Media, media)
+
+    for table in ("users", "tweets"):
+        await db.execute(
+            text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"(SELECT coalesce(max(id), 0) + 1 FROM {table}), false)"
+            )
+        )
+    await db.commit()
+    await reconcile_like_counts(db)
+    timelines = await rebuild_timelines(db)
+    return {
+        "users": users,
+        "follows": len(edges),
+        "tweets": tweet_count,
+        "likes": len(likes),
+        "media": len(media),
+        "timeline entries": timelines,
+    }
+
+
+async def reset(db: AsyncSession) -> None:
+    await db.execute(
+        text(f"TRUNCATE {', '.join(TABLES)} RESTART IDENTITY CASCADE")
+    )
+    await db.commit()
+
+
+async def run(args) -> None:
+    start = time.perf_counter()
+    async with Session() as db:
+        if args.reset:
+            await reset(db)
+        counts = await seed(
+            db,
+            users=args.users,
+            tweets_per_user=args.tweets_per_user,
+            follows_per_user=args.follows_per_user,
+            likes_per_tweet=args.likes_per_tweet,
+            media_share=args.media_share,
+            exponent=args.exponent,
+            seed=args.seed,
+        )
+    await engine.dispose()
+    for name, count in counts.items():
+        print(f"{name:>16} {count:>10}")
+    print(f"seeded in {time.perf_counter() - start:.1f}s")
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--tweets-per-user", type=float, default=10)
+    parser.add_argument("--follows-per-user", type=float, default=20)
+    parser.add_argument("--likes-per-tweet", type=float, default=3)
+    parser.add_argument("--media-share", type=float, default=0.2)
+    parser.add_argument(
+        "--exponent",
+        type=float,
+        default=1.1,
+        help="power-law exponent of follower and like popularity",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.seed")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--reset", action="store_true")
+    add_arguments(parser)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Per-request cost of serializing a feed page.
+
+Builds feed payloads shaped like the ones produced by app.loaders and
+times each way of turning them into a response body:
+
+    python -m benchmarks.serialization --sizes 100 1000 --repeat 50
+
+encoder+json is FastAPI's default for a route without a response model,
+model+json and model+orjson validate through the response model first, and
+orjson is the path taken by the read routes.
+"""
+
+import argparse
+import random
+import statistics
+import time
+from typing import Dict
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import TypeAdapter
+
+from app.schemas import FeedOut
+
+feed_adapter = TypeAdapter(FeedOut)
+
+
+def make_feed(size: int, seed: int = 0) -> Dict:
+    rng = random.Random(seed)
+    tweets = []
+    for tweet_id in range(size, 0, -1):
+        media = [
+            f"medias/{rng.getrandbits(8):02x}/{rng.getrandbits(128):032x}.jpg"
+            for _ in range(rng.choice((0, 0, 1, 2)))
+        ]
+        tweets.append(
+            {
+                "id": tweet_id,
+                "content": "x" * rng.randrange(10, 280),
+                "attachments": media,
+                "attachment_variants": [
+                    {
+                        name: {
+                            fmt: f"{link}.{name}.{fmt}"
+                            for fmt in ("webp", "jpeg")
+                        }
+                        for name in ("thumb", "medium")
+                    }
+                    for link in media
+                ],
+                "author": {"id": rng.randrange(1000), "name": "author"},
+                "likes": [
+                    {"user_id": user_id, "name": f"user{user_id}"}
+                    for user_id in rng.sample(range(1000), rng.randrange(20))
+                ],
+            }
+        )
+    return {"tweets": tweets, "next_cursor": "MC4xMi4zNA==", "result": True}
+
+
+def encoder_json(payload):
+    return JSONResponse(jsonable_encoder(payload)).body
+
+
+def model_json(payload):
+    value = feed_adapter.validate_python(payload)
+    return JSONResponse(feed_adapter.dump_python(value, mode="json")).body
+
+
+def model_orjson(payload):
+    value = feed_adapter.validate_python(payload)
+    return ORJSONResponse(feed_adapter.dump_python(value, mode="json")).body
+
+
+def orjson(payload):
+    return ORJSONResponse(payload).body
+
+
+PATHS = {
+    "encoder+json": encoder_json,
+    "model+json": model_json,
+    "model+orjson": model_orjson,
+    "orjson": orjson,
+}
+
+
+def measure(render, payload, repeat: int) -> float:
+    """Median milliseconds per call"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render(payload)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.serialization")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'tweets':>6} {'path':>13} {'ms':>9} {'speedup':>8}")
+    for size in args.sizes:
+        payload = make_feed(size)
+        baseline = None
+        for name, render in PATHS.items():
+            elapsed = measure(render, payload, args.repeat)
+            baseline = baseline or elapsed
+            print(
+                f"{size:>6} {name:>13} {elapsed:>9.2f} {baseline / elapsed:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
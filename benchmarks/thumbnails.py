@@ -0,0 +1,77 @@
+"""Images processed per second per core by the thumbnail pipeline.
+
+Generates synthetic photos, renders every variant of each through a
+process pool of 1..N workers, and reports throughput:
+
+    python -m benchmarks.thumbnails --images 48 --size 3000x2000
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from app.thumbnails import render_variants
+
+
+def make_photo(path: Path, width: int, height: int, seed: int) -> None:
+    """Noise plus shapes, so encoders cannot cheat on flat colour"""
+    rng = random.Random(seed)
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(20, max(21, width // 6))
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), colour)
+    image.filter(ImageFilter.GaussianBlur(2)).save(path, "JPEG", quality=92)
+
+
+def run(sources, target_dir: str, workers: int) -> float:
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        # warm the workers up so process start-up is not measured
+        list(pool.map(abs, range(workers)))
+        start = time.perf_counter()
+        jobs = [
+            pool.submit(
+                render_variants, str(source), f"{target_dir}/{workers}", stem
+            )
+            for stem, source in sources
+        ]
+        for job in jobs:
+            job.result()
+        return len(sources) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.thumbnails")
+    parser.add_argument("--images", type=int, default=48)
+    parser.add_argument("--size", default="3000x2000")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    width, height = (int(side) for side in args.size.split("x"))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        sources = []
+        for number in range(args.images):
+            path = Path(workdir) / f"source-{number}.jpg"
+            make_photo(path, width, height, number)
+            sources.append((f"image{number}", path))
+
+        print(f"{'workers':>7} {'images/s':>9} {'images/s/core':>14}")
+        workers = 1
+        while workers <= args.max_workers:
+            rate = run(sources, workdir, workers)
+            print(f"{workers:>7} {rate:>9.1f} {rate / workers:>14.1f}")
+            workers *= 2
+
+
+if __name__ == "__main__":
+    main()
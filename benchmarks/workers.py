@@ -0,0 +1,148 @@
+"""Throughput of the production server profile by number of workers.
+
+Starts the app with app/gunicorn.conf.py (or `uvicorn --workers` when
+gunicorn is not installed) for 1, 2, 4... workers up to --max-workers and
+loads it from --clients client processes for --duration seconds. The
+database must be seeded first:
+
+    python -m benchmarks.seed --users 10000 --reset
+    python -m benchmarks.workers --path /api/tweets --max-workers 8
+
+Requests use the api keys of the seeded users. Run the clients on other
+cores than the workers (or another machine with --url) when measuring, or
+the load generator competes with the server for CPU.
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+import httpx
+
+from benchmarks.seed import api_key
+
+
+def server_command(workers: int, port: int) -> List[str]:
+    if importlib.util.find_spec("gunicorn"):
+        return [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-c",
+            "app/gunicorn.conf.py",
+            "--bind",
+            f"127.0.0.1:{port}",
+            "--access-logfile",
+            "/dev/null",
+            "app.main:app",
+        ]
+    return [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "app.main:app",
+        "--port",
+        str(port),
+        "--workers",
+        str(workers),
+        "--loop",
+        "uvloop",
+        "--http",
+        "httptools",
+        "--no-access-log",
+    ]
+
+
+def start_server(workers: int, port: int, budget: int) -> subprocess.Popen:
+    env = os.environ | {
+        "WEB_CONCURRENCY": str(workers),
+        "PG_CONNECTION_BUDGET": str(budget),
+    }
+    server = subprocess.Popen(server_command(workers, port), env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/openapi.json", timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("server did not start")
+
+
+def client(args: Tuple[str, str, int, float, int, int]) -> List[float]:
+    """Send requests for duration seconds over `connections` connections
+    and return their latencies"""
+    url, path, users, duration, connections, seed = args
+    rng = random.Random(seed)
+
+    async def run() -> List[float]:
+        timings: List[float] = []
+        deadline = time.perf_counter() + duration
+        limits = httpx.Limits(max_connections=connections)
+        async with httpx.AsyncClient(
+            base_url=url, limits=limits, timeout=30
+        ) as http:
+
+            async def loop():
+                while time.perf_counter() < deadline:
+                    headers = {"Api-Key": api_key(rng.randint(1, users))}
+                    start = time.perf_counter()
+                    await http.get(path, headers=headers)
+                    timings.append(time.perf_counter() - start)
+
+            await asyncio.gather(*(loop() for _ in range(connections)))
+        return timings
+
+    return asyncio.run(run())
+
+
+def load(args, url: str) -> Tuple[float, float]:
+    """Return req/s and p99 latency in ms"""
+    jobs = [
+        (url, args.path, args.users, args.duration, args.connections, number)
+        for number in range(args.clients)
+    ]
+    with multiprocessing.Pool(args.clients) as pool:
+        timings = [t for result in pool.map(client, jobs) for t in result]
+    p99 = statistics.quantiles(timings, n=100)[98] * 1000
+    return len(timings) / args.duration, p99
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.workers")
+    parser.add_argument("--path", default="/api/users/me")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--connections", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--budget", type=int, default=80)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    url = f"http://127.0.0.1:{args.port}"
+    print(f"{'workers':>7} {'req/s':>9} {'req/s/worker':>13} {'p99 ms':>8}")
+    workers = 1
+    while workers <= args.max_workers:
+        server = start_server(workers, args.port, args.budget)
+        try:
+            load(args, url)  # warm-up: pools, caches, first imports
+            rate, p99 = load(args, url)
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"{workers:>7} {rate:>9.1f} {rate / workers:>13.1f} {p99:>8.1f}")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
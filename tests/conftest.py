@@ -1,13 +1,17 @@
 import os
+from contextlib import contextmanager
 
 import pytest
 from dotenv import load_dotenv
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from sqlalchemy_utils import create_database, database_exists, drop_database
 
-from app.database import Base, get_db
+from app import media, thumbnails
+from app.database import Base, get_db, get_primary_db, get_read_db
 from app.main import app
 from app.models import Key, User
 
@@ -20,6 +24,9 @@ PG_DATABASE = os.environ.get("PG_DATABASE")
 TEST_DATABASE_URL = (
     f"postgresql+psycopg2://{PG_USER}:{PG_PASSWORD}@{PG_HOST}/{PG_DATABASE}"
 )
+TEST_ASYNC_DATABASE_URL = (
+    f"postgresql+asyncpg://{PG_USER}:{PG_PASSWORD}@{PG_HOST}/{PG_DATABASE}"
+)
 TEST_USER = {"username": "test_user", "api_key": "test_key"}
 FAKE_USER = {"username": "fake_user", "api_key": "fake_key"}
 
@@ -32,16 +39,38 @@ create_database(TEST_DATABASE_URL)
 Base.metadata.create_all(test_engine)
 TestingSession = sessionmaker(autoflush=False, bind=test_engine, expire_on_commit=False)
 
+# TestClient runs every request in a new event loop, so asyncpg connections
+# must not outlive a request
+test_async_engine = create_async_engine(TEST_ASYNC_DATABASE_URL, poolclass=NullPool)
+AsyncTestingSession = async_sessionmaker(
+    autoflush=False, bind=test_async_engine, expire_on_commit=False
+)
+
 
-def override_get_db():
+@contextmanager
+def count_queries():
+    """Collect the SQL statements sent by the application while in the block"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sync_engine = test_async_engine.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
     try:
-        db = TestingSession()
-        yield db
+        yield statements
     finally:
-        db.close()
+        event.remove(sync_engine, "before_cursor_execute", before_cursor_execute)
+
+
+async def override_get_db():
+    async with AsyncTestingSession() as db:
+        yield db
 
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_read_db] = override_get_db
+app.dependency_overrides[get_primary_db] = override_get_db
 
 
 @pytest.fixture(scope="module", autouse=True)
@@ -65,4 +94,12 @@ def prepare():
     drop_database(TEST_DATABASE_URL)
 
 
+@pytest.fixture(autouse=True)
+def media_dir(tmp_path, monkeypatch):
+    """Keep uploads and their variants out of the working tree"""
+    monkeypatch.setattr(media, "MEDIA_DIR", str(tmp_path))
+    monkeypatch.setattr(thumbnails, "MEDIA_DIR", str(tmp_path))
+    return tmp_path
+
+
 client = TestClient(app)
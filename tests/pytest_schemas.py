@@ -1,13 +1,17 @@
+from pytest_schema import Optional, Or
+
 tweet_schema = {
     "tweets": [
         {
             "id": int,
             "content": str,
             "attachments": [str],
+            "attachment_variants": [{Optional(str): {Optional(str): str}}],
             "author": {"id": int, "name": str},
             "likes": [{"user_id": int, "name": str}],
         },
     ],
+    "next_cursor": Or(str, None),
     "result": True,
 }
 